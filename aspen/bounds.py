@@ -0,0 +1,125 @@
+# Author: Roman Sloutsky <sloutsky@wustl.edu>
+
+#===============================================================================
+# Tree consistency of leaf triplets for bounding assembly scores
+#===============================================================================
+
+# The best case score of an assembly bounds each pair of leaves on its own, but
+# the distances of the three pairs of any three leaves must come from one tree.
+# With distances counted in internal nodes on the path between two leaves, if x
+# and y are the two leaves of a triplet that are closest to each other, then
+# d(x,y)+3 <= d(x,z)+d(y,z) and |d(x,z)-d(y,z)| <= d(x,y)-1, and the three
+# distances always add up to an odd number. The best distances of the pairs of
+# a triplet on their own (three leaves all at distance 2 from each other, say)
+# are often not consistent with each other, and the most the triplet can add
+# jointly is then less than the sum of what its pairs can add separately.
+#
+# Triplets of free leaves are packed, disjointly, so that what they can add
+# jointly is bounded without counting any pair twice. Packing is done once, for
+# assemblies with all leaves free, and a packed triplet tightens the bound of
+# an assembly as long as all three of its leaves are still free.
+#
+# Once leaves are in built clades, the same holds for more than three of them.
+# A built clade only gets new nodes above its root, so a leaf x in it ends up at
+# its depth in the clade plus the distance from the clade's root to any leaf
+# outside it. Two leaves of a clade are thus at the same distance, less their
+# depths, from every leaf outside it (as in a triplet ((x,y),z)), and all pairs
+# of leaves of two built clades at the same distance, less their depths, from
+# each other (as in a quartet ((x,y),(z,w))). All pairs between two built
+# clades, or a built clade and a free leaf, are bounded jointly by the most they
+# can add at one such distance, which takes every pair at most once.
+
+import numpy as np
+
+
+def consistent_triplet_distances(d_xy,d_xz,d_yz):
+  '''
+  Whether the distances between three leaves could come from one tree. Works
+  elementwise on arrays of distances.
+  '''
+  def closest(d_c,d_1,d_2):
+    return (d_c+3 <= d_1+d_2) & (abs(d_1-d_2) <= d_c-1)
+  return ((d_xy+d_xz+d_yz) % 2 == 1) & (closest(d_xy,d_xz,d_yz) |
+                                        closest(d_xz,d_xy,d_yz) |
+                                        closest(d_yz,d_xy,d_xz))
+
+
+def triplet_gains(pair_log_freqs,num_leaves,chunk_size=1000):
+  '''
+  Triplets of leaves (x < y < z) whose pairs' best distances (the shortest of
+  any that tie) aren't consistent, as a (triplet x 3) array of leaf ids, and by
+  how much the most each can add jointly falls short of the sum of the most each
+  of its pairs can add on its own. No other triplet falls short at all.
+  pair_log_freqs is indexed by pair id and distance, with -inf for distances a
+  pair can't be at, and triplets with a pair that can't be at any distance are
+  left out. Triplets with no consistent distances have inf gain.
+  '''
+  best = pair_log_freqs.max(axis=1)
+  best_dists = pair_log_freqs.argmax(axis=1)
+  # Triplets are checked one leaf x at a time, against all pairs of leaves y < z
+  # above it, so only those pairs, and the inconsistent triplets, are ever held
+  # in memory. Pair ids are those of constraints.pair_id, for y < z.
+  chunks = []
+  for x in xrange(num_leaves-2):
+    y,z = np.triu_indices(num_leaves-x-1,1)
+    y += x+1
+    z += x+1
+    pairs = np.column_stack((y*(y-1)//2+x,z*(z-1)//2+x,z*(z-1)//2+y))
+    d = best_dists[pairs]
+    candidates = ~np.isneginf(best[pairs]).any(axis=1) &\
+                 ~consistent_triplet_distances(d[:,0],d[:,1],d[:,2])
+    chunks.append(np.column_stack((np.repeat(x,candidates.sum()),y[candidates],
+                                   z[candidates])))
+  triplets = np.vstack(chunks+[np.zeros((0,3),dtype=int)]).astype(int)
+  x,y,z = triplets[:,0],triplets[:,1],triplets[:,2]
+  pairs = np.column_stack((y*(y-1)//2+x,z*(z-1)//2+x,z*(z-1)//2+y))
+  gains = np.zeros(len(triplets))
+  # Distances each pair can be at, in increasing order, padded with distances it
+  # can't be at
+  can_be_at = ~np.isneginf(pair_log_freqs)
+  width = max(int(can_be_at.sum(axis=1).max()),1)
+  dists = np.argsort(~can_be_at,axis=1,kind='mergesort')[:,:width]
+  log_freqs = pair_log_freqs[np.arange(len(pair_log_freqs))[:,np.newaxis],dists]
+  for start in xrange(0,len(triplets),chunk_size):
+    chunk = slice(start,start+chunk_size)
+    p = pairs[chunk]
+    d_xy = dists[p[:,0]][:,:,np.newaxis,np.newaxis]
+    d_xz = dists[p[:,1]][:,np.newaxis,:,np.newaxis]
+    d_yz = dists[p[:,2]][:,np.newaxis,np.newaxis,:]
+    joint = log_freqs[p[:,0]][:,:,np.newaxis,np.newaxis]+\
+            log_freqs[p[:,1]][:,np.newaxis,:,np.newaxis]+\
+            log_freqs[p[:,2]][:,np.newaxis,np.newaxis,:]
+    joint = np.where(consistent_triplet_distances(d_xy,d_xz,d_yz),joint,-np.inf)
+    gains[chunk] = best[p].sum(axis=1)-joint.reshape(len(p),-1).max(axis=1)
+  return triplets,gains
+
+
+def pack_triplets(triplets,gains):
+  '''
+  Disjoint triplets with positive gains, picked greedily in order of gain, and
+  their gains.
+  '''
+  used = set()
+  packed = []
+  for i in np.argsort(-gains,kind='mergesort').tolist():
+    if not gains[i] > 0:
+      break
+    leaves = triplets[i].tolist()
+    if used.isdisjoint(leaves):
+      used.update(leaves)
+      packed.append(i)
+  return triplets[packed].reshape(-1,3),gains[packed]
+
+
+def shared_distance_bounds(log_freq_table,pairs,offsets,starts):
+  '''
+  Most each group of pairs can add jointly if all pairs of the group are at their
+  offsets plus the same distance of at least 1. Groups are runs of consecutive
+  pairs, starting at the given indeces. log_freq_table is indexed by pair id and
+  distance, and distances beyond it can't be taken.
+  '''
+  width = log_freq_table.shape[1]
+  dists = offsets[:,np.newaxis]+np.arange(1,max(width-int(offsets.min()),2))
+  log_freqs = np.where(dists < width,log_freq_table[pairs[:,np.newaxis],
+                                                    np.minimum(dists,width-1)],-np.inf)
+  return np.add.reduceat(log_freqs,starts,axis=0).max(axis=1)
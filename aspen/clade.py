@@ -0,0 +1,80 @@
+# Author: Roman Sloutsky <sloutsky@wustl.edu>
+
+#===============================================================================
+# Hash-consed clades for topology assembly
+#===============================================================================
+
+# A clade is built by every extension of every assembly, so assembly works on
+# these minimal nodes instead of Bio.Phylo clades. Leaves are integer ids, and a
+# node holds its two children, the bitmask of its leaves and its depth, the
+# number of internal nodes on the longest path from it down to a leaf. Nodes are
+# interned on their children, so each distinct clade exists only once, compares
+# by identity and shares its sub-clades with every clade containing it. Bio.Phylo
+# trees are only built from nested set representations for output (see
+# tree.T.rebuild_on_unpickle).
+
+import weakref
+from .constraints import mask_leaves
+
+
+class CladeNode(object):
+
+  __slots__ = ('children','mask','depth','_hash','_nested_set_repr','__weakref__')
+
+  _interned = weakref.WeakValueDictionary()
+
+  def __new__(cls,child1,child2):
+    key = frozenset((child1,child2))
+    node = cls._interned.get(key)
+    if node is None:
+      node = object.__new__(cls)
+      node.children = (child1,child2)
+      node.mask = 0
+      node.depth = 1
+      for child in node.children:
+        if isinstance(child,int):
+          node.mask |= 1 << child
+        else:
+          node.mask |= child.mask
+          node.depth = max(node.depth,child.depth+1)
+      # Hashes of children are cached too, so the hash of the key only involves
+      # hashing the two children
+      node._hash = hash(key)
+      node._nested_set_repr = None
+      cls._interned[key] = node
+    return node
+
+  def __hash__(self):
+    return self._hash
+
+  def __reduce__(self):
+    return (type(self),self.children)
+
+  def __repr__(self):
+    return 'CladeNode(%r,%r)' % self.children
+
+  @classmethod
+  def from_nested_set(cls,nested_set):
+    # Nested frozensets of leaf ids, as returned by nested_set_repr
+    return cls(*[member if isinstance(member,int) else cls.from_nested_set(member)
+                 for member in nested_set])
+
+  def nested_set_repr(self):
+    if self._nested_set_repr is None:
+      self._nested_set_repr = frozenset(child if isinstance(child,int) else
+                                        child.nested_set_repr()
+                                        for child in self.children)
+    return self._nested_set_repr
+
+  @property
+  def leaves(self):
+    return mask_leaves(self.mask)
+
+  def leaf_depths(self,depth=1):
+    # (leaf, number of internal nodes between leaf and this clade's root) pairs
+    for child in self.children:
+      if isinstance(child,int):
+        yield child,depth
+      else:
+        for leaf_depth in child.leaf_depths(depth+1):
+          yield leaf_depth
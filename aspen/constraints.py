@@ -0,0 +1,186 @@
+# Author: Roman Sloutsky <sloutsky@wustl.edu>
+
+#===============================================================================
+# Pairwise distance constraints
+#===============================================================================
+
+# The constraints of a leaf pair are the distances in its histogram, taken in the
+# order they are listed in (most to least frequent), for which the summed
+# frequency of the distances listed before them is still below the constraint
+# frequency cutoff. Histograms are padded into (pair x entry) arrays, so the
+# running sums of all pairs come out of a single cumulative sum, and constraint
+# sets for any number of cutoffs can be read off the same sums.
+
+import itertools
+from collections import namedtuple
+import numpy as np
+
+
+LPDF = namedtuple('LeafPairDistanceFrequency',['pair','leaves','dist','freq','logfreq',
+                                                'mask'])
+ConstraintCounts = namedtuple('ConstraintCounts',['entries','kept','kept_above_abs_cutoff'])
+
+
+def pair_id(leaf1,leaf2):
+  # Canonical index of an unordered pair of integer leaf ids. Pairs are numbered
+  # (0,1),(0,2),(1,2),(0,3),... so indeces are dense over all pairs of leaves.
+  if leaf1 < leaf2:
+    return leaf2*(leaf2-1)//2+leaf1
+  else:
+    return leaf1*(leaf1-1)//2+leaf2
+
+
+def mask_leaves(mask):
+  # Ids of the leaves whose bits are set in a leaf mask, in increasing order
+  leaves = []
+  while mask:
+    leaf_bit = mask & -mask
+    leaves.append(leaf_bit.bit_length()-1)
+    mask ^= leaf_bit
+  return leaves
+
+
+class ConstraintCompiler(object):
+
+  def __init__(self,pair_ids,histograms):
+    '''
+    pair_ids and histograms are parallel sequences of integer pair ids and the
+    [(dist, freq)] histograms of those pairs.
+    '''
+    lengths = [len(h) for h in histograms]
+    width = max(lengths) if lengths else 0
+    dists = np.zeros((len(lengths),width),dtype=int)
+    freqs = np.zeros((len(lengths),width))
+    for row,histogram in enumerate(histograms):
+      if histogram:
+        dists[row,:len(histogram)],freqs[row,:len(histogram)] = zip(*histogram)
+    self._set_entries(pair_ids,dists,freqs,lengths)
+
+  @classmethod
+  def from_arrays(cls,pair_ids,offsets,dists,freqs):
+    '''
+    Same as constructing from histograms, with the entries of all histograms in
+    flat arrays of distances and frequencies, the entries of the i-th pair running
+    from offsets[i] to offsets[i+1], as they are laid out in a compiled histogram
+    file. The entries are padded without a Python loop over them.
+    '''
+    offsets = np.asarray(offsets,dtype=int)
+    lengths = np.diff(offsets)
+    width = int(lengths.max()) if len(lengths) else 0
+    rows = np.repeat(np.arange(len(lengths)),lengths)
+    columns = np.arange(offsets[0],offsets[-1])-np.repeat(offsets[:-1],lengths)
+    padded_dists = np.zeros((len(lengths),width),dtype=int)
+    padded_freqs = np.zeros((len(lengths),width))
+    padded_dists[rows,columns] = dists[offsets[0]:offsets[-1]]
+    padded_freqs[rows,columns] = freqs[offsets[0]:offsets[-1]]
+    compiler = cls.__new__(cls)
+    compiler._set_entries(pair_ids,padded_dists,padded_freqs,lengths)
+    return compiler
+
+  def _set_entries(self,pair_ids,dists,freqs,lengths):
+    self.pair_ids = np.asarray(pair_ids,dtype=int)
+    self.dists = dists
+    self.freqs = freqs
+    width = dists.shape[1]
+    self.valid = np.arange(width) < np.array(lengths,dtype=int)[:,np.newaxis]
+    # Summed frequency of the entries preceding each entry in its histogram, with
+    # padding set to inf so that no cutoff ever keeps it
+    self.preceding_freqs = np.zeros((len(lengths),width))
+    np.cumsum(self.freqs[:,:-1],axis=1,out=self.preceding_freqs[:,1:])
+    self.preceding_freqs[~self.valid] = np.inf
+
+  def kept(self,constraint_freq_cutoff):
+    return self.preceding_freqs < constraint_freq_cutoff
+
+  def count_kept(self,constraint_freq_cutoffs,absolute_freq_cutoff=None):
+    '''
+    Number of constraints kept by each of the given constraint frequency cutoffs,
+    out of all histogram entries. If absolute_freq_cutoff is given, constraints
+    with lower frequencies are not counted.
+    '''
+    if absolute_freq_cutoff is None:
+      passing = self.valid
+    else:
+      passing = self.valid & (self.freqs >= absolute_freq_cutoff)
+    return [(cutoff,int(np.count_nonzero(self.kept(cutoff) & passing)))
+            for cutoff in constraint_freq_cutoffs]
+
+  def report(self,constraint_freq_cutoff,absolute_freq_cutoff):
+    '''
+    How many of all histogram entries the constraint frequency cutoff keeps, and
+    how many of those are also at or above the absolute frequency cutoff.
+    '''
+    [(_,kept)] = self.count_kept([constraint_freq_cutoff])
+    [(_,kept_above_abs_cutoff)] = self.count_kept([constraint_freq_cutoff],
+                                                  absolute_freq_cutoff)
+    return ConstraintCounts(int(np.count_nonzero(self.valid)),kept,
+                            kept_above_abs_cutoff)
+
+  def compile(self,constraint_freq_cutoff,pair_leaves,log_freq_table):
+    '''
+    Constraints kept by the cutoff as a ConstraintTable, sorted on (shortest
+    dist, highest freq). Log frequencies are read from log_freq_table, indexed
+    by pair id and distance.
+    '''
+    rows,entries = np.nonzero(self.kept(constraint_freq_cutoff))
+    pair = self.pair_ids[rows]
+    dist = self.dists[rows,entries]
+    freq = self.freqs[rows,entries]
+    # lexsort is stable, so ties keep the order of the histograms
+    order = np.lexsort((1-freq,dist))
+    pair,dist,freq = pair[order],dist[order],freq[order]
+    return ConstraintTable(pair,dist,freq,log_freq_table[pair,dist],pair_leaves)
+
+
+class ConstraintTable(tuple):
+  '''
+  Constraints as a tuple of LPDF rows, for looking up single constraints in the
+  assembly loop, and as read-only columns (pair, leaf1, leaf2, dist, freq,
+  logfreq) for working on all of them at once. The mask of a row has the bits
+  of both its leaves set.
+  
+  Constraints are also indexed by pair, with by_pair[pair id] holding the ids
+  (row numbers) of the pair's constraints, and by leaf and distance, with
+  by_leaf[leaf][dist] holding the ids of constraints of that distance between
+  the leaf and any other leaf.
+  '''
+
+  def __new__(cls,pair,dist,freq,logfreq,pair_leaves):
+    pair_leaves_list = [pair_leaves[p] for p in pair.tolist()]
+    table = tuple.__new__(cls,itertools.starmap(LPDF,itertools.izip(
+                                      pair.tolist(),
+                                      itertools.imap(frozenset,pair_leaves_list),
+                                      dist.tolist(),freq.tolist(),logfreq.tolist(),
+                                      ((1 << leaf1)|(1 << leaf2)
+                                       for leaf1,leaf2 in pair_leaves_list))))
+    table.pair_leaves = pair_leaves
+    leaves = np.array(pair_leaves_list,dtype=int).reshape(len(pair_leaves_list),2)
+    for name,column in (('pair',pair),('leaf1',leaves[:,0]),('leaf2',leaves[:,1]),
+                        ('dist',dist),('freq',freq),('logfreq',logfreq)):
+      column = np.array(column)
+      column.flags.writeable = False
+      setattr(table,name,column)
+    table.by_pair = table._group_ids(table.pair,len(pair_leaves))
+    num_leaves = pair_leaves[-1][1]+1 if pair_leaves else 0
+    width = int(dist.max())+1 if len(dist) else 1
+    by_leaf_dist = table._group_ids(np.concatenate((table.leaf1,table.leaf2))*width+
+                                    np.concatenate((dist,dist)),num_leaves*width,
+                                    np.concatenate((np.arange(len(table)),)*2))
+    table.by_leaf = [{d:ids for d,ids in enumerate(by_leaf_dist[leaf*width:(leaf+1)*width])
+                      if len(ids)}
+                     for leaf in xrange(num_leaves)]
+    return table
+  
+  @staticmethod
+  def _group_ids(keys,num_keys,ids=None):
+    # Ids grouped by key into a list of read-only arrays, one for each key
+    if ids is None:
+      ids = np.arange(len(keys))
+    order = np.argsort(keys,kind='mergesort')
+    groups = np.split(ids[order],np.cumsum(np.bincount(keys,minlength=num_keys))[:-1])
+    for group in groups:
+      group.flags.writeable = False
+    return groups
+
+  def __reduce__(self):
+    return (type(self),(self.pair,self.dist,self.freq,self.logfreq,self.pair_leaves))
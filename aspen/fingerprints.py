@@ -0,0 +1,246 @@
+# Author: Roman Sloutsky <sloutsky@wustl.edu>
+
+#===============================================================================
+# Shared-memory set of 64-bit fingerprints of encountered assemblies
+#===============================================================================
+
+# Workers remember the assemblies they encounter as 64-bit fingerprints of their
+# CladeReprTracker string representations, in an open-addressing hash table in
+# shared memory. Processes forked from the one that created the table read and
+# write it directly, instead of each lookup being a round trip to a manager
+# process. The table is split into stripes, each an independent table probed
+# linearly and guarded by its own lock, and fingerprints are assigned to stripes
+# by their low bits, so workers only wait for each other when they touch the same
+# stripe. Forgotten fingerprints leave tombstones behind, which are cleared by
+# rehashing a stripe once it fills up, and a stripe filled up with fingerprints
+# grows instead. Shared memory can't be resized, so each stripe is a file mapped
+# by every process that uses it; a grown stripe is rehashed into a new file, and
+# processes map it the next time they lock the stripe.
+#
+# Two distinct assemblies share a fingerprint with probability of about n^2/2^65
+# for n remembered assemblies, in which case the second one is wrongly taken for
+# having been encountered.
+
+import os
+import mmap
+import atexit
+import shutil
+import struct
+import ctypes
+import hashlib
+import tempfile
+import multiprocessing
+from multiprocessing import sharedctypes
+from collections import namedtuple
+
+EMPTY = 0
+DELETED = 1
+
+
+FingerprintSetStats = namedtuple('FingerprintSetStats',['capacity','size','load_factor',
+                                                        'max_stripe_load_factor',
+                                                        'tombstones','lookups',
+                                                        'collisions'])
+
+
+def fingerprint(key):
+  '''
+  64-bit fingerprint of a string, never one of the values marking empty and
+  deleted slots.
+  '''
+  fp = struct.unpack('<Q',hashlib.md5(key).digest()[:8])[0]
+  return fp if fp > DELETED else fp+2
+
+
+class SharedFingerprintSet(object):
+  '''
+  Set of strings, kept as their fingerprints in shared memory (see above), that
+  stands in for the shared dict of a SharedCladeReprTracker: it supports
+  membership, assignment of any value and pop by string key. Capacity is rounded
+  up so that there is a power of two of stripes of a power of two of slots each,
+  and a stripe that is more than max_load_factor full, even without its
+  tombstones, doubles in size. The stripes are files in a temporary directory,
+  in /dev/shm where there is one, which is removed by close().
+  '''
+
+  # Counters kept for each stripe
+  SIZE,TOMBSTONES,LOOKUPS,COLLISIONS,GENERATION,SIZE_BITS = range(6)
+  NUM_COUNTERS = 6
+
+  def __init__(self,capacity=2**22,num_stripes=64,max_load_factor=0.9):
+    self.num_stripes = 1 << max(num_stripes-1,0).bit_length()
+    self.stripe_bits = self.num_stripes.bit_length()-1
+    self.max_load_factor = max_load_factor
+    size_bits = max(-(-capacity//self.num_stripes)-1,7).bit_length()
+    self.directory = tempfile.mkdtemp(prefix='aspen_fingerprints_',
+                                      dir='/dev/shm' if os.path.isdir('/dev/shm') else None)
+    atexit.register(self.close)
+    self.counters = sharedctypes.RawArray(ctypes.c_int64,self.num_stripes*self.NUM_COUNTERS)
+    self.locks = [multiprocessing.Lock() for _ in xrange(self.num_stripes)]
+    # Each process maps the current generation of each stripe the first time it
+    # touches it after the stripe grows, as (generation,table)
+    self.tables = [None]*self.num_stripes
+    for stripe in xrange(self.num_stripes):
+      self.counters[stripe*self.NUM_COUNTERS+self.SIZE_BITS] = size_bits
+      self.tables[stripe] = (0,self._map(stripe,0,1 << size_bits,create=True))
+
+  @property
+  def capacity(self):
+    return sum(1 << bits for bits in self.counters[self.SIZE_BITS::self.NUM_COUNTERS])
+
+  def _path(self,stripe,generation):
+    return os.path.join(self.directory,'%d.%d' % (stripe,generation))
+
+  def _map(self,stripe,generation,size,create=False):
+    # Table of a generation of a stripe, as an array of slots in a shared mapping
+    # of its file. The array keeps the mapping open, which outlives the file.
+    with open(self._path(stripe,generation),'w+b' if create else 'r+b') as f:
+      if create:
+        f.truncate(size*ctypes.sizeof(ctypes.c_uint64))
+      mapping = mmap.mmap(f.fileno(),size*ctypes.sizeof(ctypes.c_uint64))
+    return (ctypes.c_uint64*size).from_buffer(mapping)
+
+  def _table(self,stripe):
+    # Current table of a stripe, which must be locked
+    generation = self.counters[stripe*self.NUM_COUNTERS+self.GENERATION]
+    if self.tables[stripe][0] != generation:
+      size = 1 << self.counters[stripe*self.NUM_COUNTERS+self.SIZE_BITS]
+      self.tables[stripe] = (generation,self._map(stripe,generation,size))
+    return self.tables[stripe][1]
+
+  def _max_fill(self,table):
+    return min(int(len(table)*self.max_load_factor),len(table)-1)
+
+  def _probe(self,table,fp):
+    # Slot holding fp, or None if it isn't in the table, the first empty or
+    # deleted slot it could be added in, and the number of slots probed past the
+    # first. Fingerprints are assigned to stripes by their low bits, and probing
+    # starts from the slot given by the bits above those.
+    mask = len(table)-1
+    start = fp >> self.stripe_bits
+    free = None
+    for i in xrange(len(table)):
+      slot = (start+i) & mask
+      value = table[slot]
+      if value == fp:
+        return slot,free,i
+      elif value == EMPTY:
+        return None,slot if free is None else free,i
+      elif value == DELETED and free is None:
+        free = slot
+    return None,free,len(table)
+
+  def _count_lookup(self,stripe,probes):
+    self.counters[stripe*self.NUM_COUNTERS+self.LOOKUPS] += 1
+    self.counters[stripe*self.NUM_COUNTERS+self.COLLISIONS] += probes
+
+  def _rehash(self,stripe,table,size):
+    # Reinserts the fingerprints of a stripe into a table of the given size,
+    # clearing its tombstones, and returns the table. A table of another size
+    # starts a new generation of the stripe, whose previous file is removed.
+    live = [fp for fp in table if fp > DELETED]
+    base = stripe*self.NUM_COUNTERS
+    if size == len(table):
+      ctypes.memset(ctypes.addressof(table),0,ctypes.sizeof(table))
+    else:
+      generation = self.counters[base+self.GENERATION]
+      table = self._map(stripe,generation+1,size,create=True)
+      self.tables[stripe] = (generation+1,table)
+      self.counters[base+self.SIZE_BITS] = size.bit_length()-1
+      self.counters[base+self.GENERATION] = generation+1
+      os.remove(self._path(stripe,generation))
+    for fp in live:
+      table[self._probe(table,fp)[1]] = fp
+    self.counters[base+self.TOMBSTONES] = 0
+    return table
+
+  def contains_fingerprint(self,fp):
+    stripe = fp & (self.num_stripes-1)
+    with self.locks[stripe]:
+      slot,_,probes = self._probe(self._table(stripe),fp)
+      self._count_lookup(stripe,probes)
+    return slot is not None
+
+  def add_fingerprint(self,fp):
+    # Returns whether fp was added, i.e. wasn't already in the set
+    stripe = fp & (self.num_stripes-1)
+    base = stripe*self.NUM_COUNTERS
+    counters = self.counters
+    with self.locks[stripe]:
+      table = self._table(stripe)
+      slot,free,probes = self._probe(table,fp)
+      self._count_lookup(stripe,probes)
+      if slot is not None:
+        return False
+      max_fill = self._max_fill(table)
+      if counters[base+self.SIZE] >= max_fill:
+        table = self._rehash(stripe,table,2*len(table))
+        _,free,_ = self._probe(table,fp)
+      elif table[free] == DELETED:
+        counters[base+self.TOMBSTONES] -= 1
+      elif counters[base+self.SIZE]+counters[base+self.TOMBSTONES] >= max_fill:
+        table = self._rehash(stripe,table,len(table))
+        _,free,_ = self._probe(table,fp)
+      table[free] = fp
+      counters[base+self.SIZE] += 1
+    return True
+
+  def discard_fingerprint(self,fp):
+    # Returns whether fp was removed, i.e. was in the set. A slot followed by an
+    # empty one is not on the way to any other fingerprint, and is emptied rather
+    # than marked deleted.
+    stripe = fp & (self.num_stripes-1)
+    base = stripe*self.NUM_COUNTERS
+    with self.locks[stripe]:
+      table = self._table(stripe)
+      slot,_,probes = self._probe(table,fp)
+      self._count_lookup(stripe,probes)
+      if slot is None:
+        return False
+      if table[(slot+1) & (len(table)-1)] == EMPTY:
+        table[slot] = EMPTY
+      else:
+        table[slot] = DELETED
+        self.counters[base+self.TOMBSTONES] += 1
+      self.counters[base+self.SIZE] -= 1
+    return True
+
+  def __contains__(self,key):
+    return self.contains_fingerprint(fingerprint(key))
+
+  def __setitem__(self,key,value):
+    self.add_fingerprint(fingerprint(key))
+
+  def pop(self,key):
+    if not self.discard_fingerprint(fingerprint(key)):
+      raise KeyError(key)
+
+  def __len__(self):
+    return sum(self.counters[self.SIZE::self.NUM_COUNTERS])
+
+  def fingerprints(self):
+    # Snapshot of the fingerprints in the set, taken one stripe at a time
+    snapshot = []
+    for stripe in xrange(self.num_stripes):
+      with self.locks[stripe]:
+        snapshot.extend(fp for fp in self._table(stripe) if fp > DELETED)
+    return snapshot
+
+  def stats(self):
+    # Snapshot of the counters of all stripes, taken without locking them. Lookups
+    # include those done to add and discard fingerprints, and collisions are the
+    # total number of slots they probed past the first.
+    counters = self.counters[:]
+    sizes = counters[self.SIZE::self.NUM_COUNTERS]
+    stripe_sizes = [1 << bits for bits in counters[self.SIZE_BITS::self.NUM_COUNTERS]]
+    size = sum(sizes)
+    return FingerprintSetStats(sum(stripe_sizes),size,float(size)/sum(stripe_sizes),
+                               max(float(n)/m for n,m in zip(sizes,stripe_sizes)),
+                               sum(counters[self.TOMBSTONES::self.NUM_COUNTERS]),
+                               sum(counters[self.LOOKUPS::self.NUM_COUNTERS]),
+                               sum(counters[self.COLLISIONS::self.NUM_COUNTERS]))
+
+  def close(self):
+    # Removes the files of the stripes; mappings of them stay usable until they
+    # are dropped
+    shutil.rmtree(self.directory,ignore_errors=True)
@@ -0,0 +1,136 @@
+# Author: Roman Sloutsky <sloutsky@wustl.edu>
+
+#===============================================================================
+# Pre-flight feasibility and search space analysis
+#===============================================================================
+
+# A leaf pair can only end up at a distance that is either one of its
+# constraints, or that was observed with a frequency of at least the absolute
+# frequency cutoff, and no two leaves are ever more than n-1 internal nodes
+# apart. If any pair has no such distance, no topology can be assembled.
+# Cherries are only ever formed from distance 1 constraints, so leaves without
+# one can only be attached to clades, and assembly can't start without at least
+# one cherry. Distinct topologies have distinct distances for at least one pair,
+# so the product over pairs of the number of feasible distances bounds the
+# number of topologies that can be assembled.
+#
+# All of this is computed from the histograms alone, before any processes are
+# started.
+
+import sys
+import math
+from collections import namedtuple
+import numpy as np
+from .constraints import ConstraintCompiler,pair_id
+from .pwhist import load_pwhist
+
+
+class InfeasibleConfigurationError(ValueError):
+  pass
+
+
+PreflightReport = namedtuple('PreflightReport',['num_leaves','constraint_counts',
+                                                'missing_pairs','infeasible_pairs',
+                                                'leaves_without_cherry_partner',
+                                                'best_possible','log10_topologies',
+                                                'log10_search_space'])
+
+
+def log10_rooted_topologies(num_leaves):
+  # (2n-3)!! rooted binary topologies of n leaves
+  return sum(math.log10(2*k-3) for k in xrange(3,num_leaves+1))
+
+
+def analyze(histograms,constraint_freq_cutoff,absolute_freq_cutoff):
+  '''
+  Returns a PreflightReport for assembling topologies from histograms with the
+  given cutoffs. Pairs and leaves are reported by name.
+  '''
+  pairs = []
+  distances = []
+  for leafpair,histogram in histograms:
+    pairs.append(tuple(sorted(leafpair)))
+    distances.append(histogram)
+  leaf_names = sorted({leaf for pair in pairs for leaf in pair})
+  leaf_ids = {leaf:i for i,leaf in enumerate(leaf_names)}
+  num_leaves = len(leaf_names)
+  all_pairs = {pair_id(leaf_ids[leaf1],leaf_ids[leaf2]):(leaf1,leaf2)
+               for leaf2 in leaf_names for leaf1 in leaf_names if leaf1 < leaf2}
+  ids = [pair_id(leaf_ids[leaf1],leaf_ids[leaf2]) for leaf1,leaf2 in pairs]
+  missing_pairs = [all_pairs[pid] for pid in sorted(set(all_pairs)-set(ids))]
+
+  compiler = ConstraintCompiler(ids,distances)
+  kept = compiler.kept(constraint_freq_cutoff)&(compiler.freqs > 0)
+  feasible = compiler.valid&(kept|(compiler.freqs >= absolute_freq_cutoff))&\
+                   (compiler.dists >= 1)&(compiler.dists <= max(num_leaves-1,1))
+  num_feasible = np.count_nonzero(feasible,axis=1)
+  infeasible_pairs = [pairs[row] for row in np.flatnonzero(num_feasible == 0)]
+  cherry_rows = np.flatnonzero((kept&(compiler.dists == 1)).any(axis=1))
+  cherry_leaves = {leaf for row in cherry_rows for leaf in pairs[row]}
+
+  observed = compiler.valid&(compiler.freqs > 0)
+  best_possible = float(sum(math.log(compiler.freqs[row][observed[row]].max())
+                            for row in np.flatnonzero(observed.any(axis=1))))
+  log10_topologies = log10_rooted_topologies(num_leaves)
+  if infeasible_pairs:
+    log10_search_space = -np.inf
+  else:
+    log10_search_space = min(log10_topologies,
+                             float(np.log10(num_feasible).sum()))
+  return PreflightReport(num_leaves,
+                         compiler.report(constraint_freq_cutoff,absolute_freq_cutoff),
+                         missing_pairs,infeasible_pairs,
+                         [leaf for leaf in leaf_names if leaf not in cherry_leaves],
+                         best_possible,log10_topologies,log10_search_space)
+
+
+def problems(report):
+  found = []
+  if report.missing_pairs:
+    found.append("%d leaf pairs have no histogram, e.g. %s" %
+                 (len(report.missing_pairs),report.missing_pairs[0]))
+  if report.infeasible_pairs:
+    found.append("%d leaf pairs have no distance allowed by the cutoffs, e.g. %s" %
+                 (len(report.infeasible_pairs),report.infeasible_pairs[0]))
+  if report.num_leaves > 1 and\
+                len(report.leaves_without_cherry_partner) > report.num_leaves-2:
+    found.append("no pair of leaves has a distance 1 constraint, so no cherry "
+                 "can be formed")
+  return found
+
+
+def check(histograms,constraint_freq_cutoff,absolute_freq_cutoff):
+  '''
+  Like analyze, but raises InfeasibleConfigurationError if no topology can be
+  assembled from histograms with the given cutoffs.
+  '''
+  report = analyze(histograms,constraint_freq_cutoff,absolute_freq_cutoff)
+  found = problems(report)
+  if found:
+    raise InfeasibleConfigurationError("; ".join(found))
+  return report
+
+
+def format_report(report):
+  counts = report.constraint_counts
+  lines = ["Leaves: %d" % report.num_leaves,
+           "Constraints kept: %d of %d histogram entries, %d above absolute "
+           "frequency cutoff" % (counts.kept,counts.entries,
+                                 counts.kept_above_abs_cutoff),
+           "Leaves without a distance 1 constraint: %d" %
+                                         len(report.leaves_without_cherry_partner),
+           "Best possible score: %0.5f" % report.best_possible,
+           "Rooted topologies: 10^%0.1f" % report.log10_topologies,
+           "Feasible topologies at most: 10^%0.1f" % report.log10_search_space]
+  lines.extend("PROBLEM: "+p for p in problems(report))
+  return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+  if len(sys.argv) not in (2,3,4):
+    print >>sys.stderr,"Usage: python -m aspen.preflight <histograms file> "\
+                       "[<constraint freq cutoff> [<absolute freq cutoff>]]"
+    sys.exit(1)
+  print format_report(analyze(load_pwhist(sys.argv[1]),
+                              float(sys.argv[2]) if len(sys.argv) > 2 else 0.9,
+                              float(sys.argv[3]) if len(sys.argv) > 3 else 0.01))
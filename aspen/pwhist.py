@@ -0,0 +1,347 @@
+# Author: Roman Sloutsky <sloutsky@wustl.edu>
+
+#===============================================================================
+# Pairwise path length histogram files
+#===============================================================================
+
+# Each line of a pairwise histogram file holds one leaf pair and its path length
+# distribution, separated by a tab:
+#
+#   frozenset(['leaf1', 'leaf2'])\t[(dist1, freq1), (dist2, freq2), ...]
+#
+# The parser below handles exactly this format (both the python 2 and python 3
+# reprs of the frozenset are accepted, as are u'' leaf names and empty histograms
+# written as []), so nothing in the file is ever executed.
+#
+# A text file can also be compiled once into a binary file, which is memory-mapped
+# on loading instead of being parsed again. The binary layout, with every section
+# starting on an 8-byte boundary and all numbers stored little-endian, is:
+#
+#   header        magic, format version, number of leaves, number of pairs,
+#                 total number of histogram entries, size of the leaf table
+#   leaf table    leaf names in sorted order separated by newlines
+#   pair leaves   int32 (number of pairs x 2) - leaf ids of each pair
+#   offsets       int64 (number of pairs + 1) - where each pair's entries start
+#   distances     int32 (number of entries)
+#   frequencies   float64 (number of entries)
+#
+# Pairs and their histogram entries keep the order they had in the text file.
+
+import os
+import sys
+import mmap
+import struct
+import itertools
+from array import array
+import numpy as np
+
+
+class PWHistFormatError(ValueError):
+  pass
+
+
+_PAIR_DELIMS = {'frozenset([':'])','frozenset({':'})'}
+
+
+def _parse_leaf_name(token):
+  quoted = token[1:] if token[:1] == 'u' else token
+  if len(quoted) < 2 or quoted[0] not in '\'"' or quoted[-1] != quoted[0]:
+    raise ValueError("leaf name is not a quoted string: "+token)
+  name = quoted[1:-1]
+  if '\\' in name or quoted[0] in name:
+    raise ValueError("unsupported characters in leaf name: "+token)
+  return name
+
+
+def _quoted_name_end(members):
+  # Where the quoted name at the start of members ends, or -1 if it doesn't start
+  # with one. Names may carry a u prefix.
+  start = 1 if members[:1] == 'u' else 0
+  quote = members[start:start+1]
+  if quote not in ('"',"'"):
+    return -1
+  end = members.find(quote,start+1)
+  return end+1 if end >= 0 else -1
+
+
+def _split_leaf_pair(members):
+  # Names can't contain their own quote character (see _parse_leaf_name), so each
+  # one ends where its opening quote is repeated, and may itself contain ', '
+  end = _quoted_name_end(members)
+  if end < 0:
+    raise ValueError("leaf name is not a quoted string: "+members)
+  second = members[end+2:]
+  if members[end:end+2] != ', ' or _quoted_name_end(second) != len(second):
+    return None
+  return members[:end],second
+
+
+def _parse_leaf_pair(field,known_names):
+  head = field[:11]
+  if head not in _PAIR_DELIMS or not field.endswith(_PAIR_DELIMS[head]):
+    raise ValueError("leaf pair is not a frozenset: "+field)
+  names = _split_leaf_pair(field[11:-2])
+  if names is None:
+    raise ValueError("leaf pair does not have exactly two members: "+field)
+  # Every leaf appears in many pairs, so each quoted name is only checked once
+  try:
+    leaf1 = known_names[names[0]]
+  except KeyError:
+    leaf1 = known_names[names[0]] = _parse_leaf_name(names[0])
+  try:
+    leaf2 = known_names[names[1]]
+  except KeyError:
+    leaf2 = known_names[names[1]] = _parse_leaf_name(names[1])
+  if leaf1 == leaf2:
+    raise ValueError("leaf pair has two identical members: "+field)
+  return frozenset((leaf1,leaf2))
+
+
+def _split_line(line,known_names):
+  pair_field,sep,hist_field = line.rstrip('\r\n').partition('\t')
+  if not sep:
+    raise ValueError("no tab separating leaf pair and histogram")
+  hist_field = hist_field.rstrip()
+  if hist_field == '[]':
+    return _parse_leaf_pair(pair_field,known_names),'',0
+  if not (hist_field.startswith('[(') and hist_field.endswith(')]')):
+    raise ValueError("histogram is not a list of tuples: "+hist_field)
+  # Every (dist, freq) entry contributes one ', ' and so does every boundary
+  # between entries, so the two counts below pin down the shape of the list
+  # before any of the values are converted.
+  num_entries = hist_field.count('), (')+1
+  if hist_field.count(', ') != 2*num_entries-1:
+    raise ValueError("histogram entries are not (dist, freq) tuples: "
+                     +hist_field)
+  return _parse_leaf_pair(pair_field,known_names),hist_field[2:-2],num_entries
+
+
+def _convert_values(joined_entries):
+  if not joined_entries:
+    return [],[]
+  values = joined_entries.replace('), (',', ').split(', ')
+  return map(int,values[::2]),map(float,values[1::2])
+
+
+def parse_pwhist_line(line):
+  '''
+  Parse one line of a pairwise histogram file into a (frozenset, [(dist, freq)])
+  tuple. Raises ValueError if the line does not follow the expected format.
+  '''
+  pair,entries,_ = _split_line(line,{})
+  return pair,zip(*_convert_values(entries))
+
+
+def _parse_block(block,source,known_names):
+  pairs = []
+  entries = []
+  sizes = []
+  for lineno,line in block:
+    try:
+      pair,pair_entries,num_entries = _split_line(line,known_names)
+    except ValueError as e:
+      raise PWHistFormatError("%s, line %d: %s" % (source,lineno,e))
+    pairs.append(pair)
+    entries.append(pair_entries)
+    sizes.append(num_entries)
+  # Converting the values of a whole block at once is where most of the
+  # speedup over per-line parsing comes from
+  try:
+    dists,freqs = _convert_values('), ('.join(e for e in entries if e))
+  except ValueError as block_error:
+    # Go line by line to find out which one is at fault
+    for lineno,line in block:
+      try:
+        parse_pwhist_line(line)
+      except ValueError as e:
+        raise PWHistFormatError("%s, line %d: %s" % (source,lineno,e))
+    raise PWHistFormatError("%s, lines %d-%d: %s" % (source,block[0][0],block[-1][0],
+                                                     block_error))
+  entries = zip(dists,freqs)
+  parsed = []
+  start = 0
+  for pair,num_entries in itertools.izip(pairs,sizes):
+    end = start+num_entries
+    parsed.append((pair,entries[start:end]))
+    start = end
+  return parsed
+
+
+def iter_pwhist(fh,source=None,block_size=4096):
+  '''
+  Stream (frozenset, [(dist, freq)]) tuples from an open pairwise histogram file
+  in a single pass, reading block_size lines at a time. Blank lines are skipped,
+  any other line that cannot be parsed raises PWHistFormatError identifying the
+  offending line.
+  '''
+  source = source or getattr(fh,'name','<pairwise histograms>')
+  known_names = {}
+  block = []
+  for lineno,line in enumerate(fh,1):
+    if not line.strip():
+      continue
+    block.append((lineno,line))
+    if len(block) == block_size:
+      for parsed in _parse_block(block,source,known_names):
+        yield parsed
+      block = []
+  if block:
+    for parsed in _parse_block(block,source,known_names):
+      yield parsed
+
+
+def load_pwhist(fpath):
+  '''
+  Load pairwise histograms from either a text file or a compiled binary file.
+  A compiled file is memory-mapped rather than read into memory.
+  '''
+  if is_compiled_pwhist(fpath):
+    return CompiledPWHist(fpath)
+  with open(fpath) as fh:
+    return list(iter_pwhist(fh))
+
+
+#------------------------------------------------------------------------------
+# Compiled binary histograms
+
+
+COMPILED_MAGIC = 'ASPENPWH'
+COMPILED_VERSION = 1
+_HEADER = struct.Struct('<8sIIQQQ')
+_HEADER_SIZE = 64
+
+
+def _padding(nbytes):
+  return -nbytes % 8
+
+
+def is_compiled_pwhist(fpath):
+  with open(fpath,'rb') as fh:
+    return fh.read(len(COMPILED_MAGIC)) == COMPILED_MAGIC
+
+
+def compile_pwhist(source,target):
+  '''
+  Write pairwise histograms to target in the compiled binary format. source is
+  either the path to a text histogram file, which is streamed, or an iterable
+  of (frozenset, [(dist, freq)]) tuples.
+  '''
+  if isinstance(source,basestring):
+    with open(source) as fh:
+      return compile_pwhist(iter_pwhist(fh),target)
+  leaf_ids = {}
+  pair_leaves = array('i')
+  offsets = array('l',[0])
+  dists = array('i')
+  freqs = array('d')
+  for pair,histogram in source:
+    for leaf in sorted(pair):
+      pair_leaves.append(leaf_ids.setdefault(leaf,len(leaf_ids)))
+    for dist,freq in histogram:
+      dists.append(dist)
+      freqs.append(freq)
+    offsets.append(len(dists))
+  # Leaf ids were handed out in order of appearance, renumber them so that
+  # they follow the sorted order of leaf names
+  leaf_names = sorted(leaf_ids)
+  renumber = np.empty(len(leaf_names),dtype='<i4')
+  for i,leaf in enumerate(leaf_names):
+    renumber[leaf_ids[leaf]] = i
+  leaf_table = '\n'.join(leaf_names)
+  
+  with open(target,'wb') as wh:
+    header = _HEADER.pack(COMPILED_MAGIC,COMPILED_VERSION,len(leaf_names),
+                          len(offsets)-1,len(dists),len(leaf_table))
+    wh.write(header+'\0'*(_HEADER_SIZE-len(header)))
+    for section in (leaf_table,
+                    renumber[np.frombuffer(pair_leaves,dtype='i')].astype('<i4'),
+                    np.frombuffer(offsets,dtype='l').astype('<i8'),
+                    np.frombuffer(dists,dtype='i').astype('<i4'),
+                    np.frombuffer(freqs,dtype='d').astype('<f8')):
+      if isinstance(section,np.ndarray):
+        section = section.tobytes()
+      wh.write(section+'\0'*_padding(len(section)))
+  return target
+
+
+class CompiledPWHist(object):
+  '''
+  Read-only, memory-mapped view of a compiled histogram file. Iterating yields
+  the same (frozenset, [(dist, freq)]) tuples as the text parser, and the
+  underlying arrays are available for vectorized use. Instances pickle as the
+  path to the file, so every process maps the same pages instead of receiving
+  its own copy of the histograms.
+  '''
+  
+  def __init__(self,fpath):
+    self.fpath = os.path.abspath(fpath)
+    with open(self.fpath,'rb') as fh:
+      self._mmap = mmap.mmap(fh.fileno(),0,access=mmap.ACCESS_READ)
+    if len(self._mmap) < _HEADER_SIZE:
+      raise PWHistFormatError(self.fpath+": too short to be a compiled "
+                              "histogram file")
+    magic,version,num_leaves,num_pairs,num_entries,leaf_table_size =\
+                                             _HEADER.unpack_from(self._mmap,0)
+    if magic != COMPILED_MAGIC:
+      raise PWHistFormatError(self.fpath+": not a compiled histogram file")
+    if version != COMPILED_VERSION:
+      raise PWHistFormatError("%s: unsupported compiled format version %d" %
+                              (self.fpath,version))
+    offset = _HEADER_SIZE
+    self.leaf_names = tuple(self._mmap[offset:offset+leaf_table_size].split('\n'))\
+                                                        if num_leaves else ()
+    offset += leaf_table_size+_padding(leaf_table_size)
+    self.pair_leaves = self._section('<i4',num_pairs*2,offset).reshape(num_pairs,2)
+    offset += self.pair_leaves.nbytes+_padding(self.pair_leaves.nbytes)
+    self.offsets = self._section('<i8',num_pairs+1,offset)
+    offset += self.offsets.nbytes
+    self.dists = self._section('<i4',num_entries,offset)
+    offset += self.dists.nbytes+_padding(self.dists.nbytes)
+    self.freqs = self._section('<f8',num_entries,offset)
+    if len(self.leaf_names) != num_leaves or\
+                             offset+self.freqs.nbytes > len(self._mmap):
+      raise PWHistFormatError(self.fpath+": compiled histogram file is "
+                              "truncated or corrupt")
+  
+  def _section(self,dtype,count,offset):
+    if offset+count*np.dtype(dtype).itemsize > len(self._mmap):
+      raise PWHistFormatError(self.fpath+": compiled histogram file is "
+                              "truncated or corrupt")
+    return np.frombuffer(self._mmap,dtype,count,offset)
+  
+  def __reduce__(self):
+    return (type(self),(self.fpath,))
+  
+  def __len__(self):
+    return len(self.pair_leaves)
+  
+  def pair(self,i):
+    leaf1,leaf2 = self.pair_leaves[i]
+    return frozenset((self.leaf_names[leaf1],self.leaf_names[leaf2]))
+  
+  def histogram(self,i):
+    start,end = self.offsets[i],self.offsets[i+1]
+    return zip(self.dists[start:end].tolist(),self.freqs[start:end].tolist())
+  
+  def __getitem__(self,i):
+    if i < 0:
+      i += len(self)
+    if not 0 <= i < len(self):
+      raise IndexError("pair index out of range")
+    return self.pair(i),self.histogram(i)
+  
+  def __iter__(self):
+    names = self.leaf_names
+    entries = zip(self.dists.tolist(),self.freqs.tolist())
+    offsets = self.offsets.tolist()
+    for i,(leaf1,leaf2) in enumerate(self.pair_leaves.tolist()):
+      yield frozenset((names[leaf1],names[leaf2])),entries[offsets[i]:offsets[i+1]]
+
+
+if __name__ == '__main__':
+  if len(sys.argv) not in (2,3):
+    print >>sys.stderr,"Usage: python -m aspen.pwhist <histograms file> "\
+                       "[<compiled file>]"
+    sys.exit(1)
+  compile_pwhist(sys.argv[1],sys.argv[2] if len(sys.argv) == 3 else
+                                               sys.argv[1]+'.compiled')
@@ -1,6 +1,7 @@
 # Author: Roman Sloutsky <sloutsky@wustl.edu>
 
 from topolenum import *
+from pwhist import load_pwhist
 import subprocess
 from sys import float_info,stderr,argv
 
@@ -8,10 +9,6 @@ from sys import float_info,stderr,argv
 # IO utils
 #===============================================================================
 
-def load_pwhist(fpath):
-  with open(fpath) as fh:
-    return [(eval(l.split('\t')[0]),eval(l.split('\t')[1])) for l in fh]
-
 def write_enumeration_results(results,targetpath):
   with open(targetpath,'w') as wh:
     for r in results:
@@ -51,6 +48,7 @@ class EnumerationObserver(object):
      
     self.first_call = True
     self.interrupt_reported = False
+    self.preflight_reported = False
    
   def time_since(self,time_in_past):
     return time.time()-time_in_past
@@ -80,18 +78,22 @@ class EnumerationObserver(object):
     print >>stderr,self.timestamp,"Elapsed since start"
     self.time_of_last_stamp = time.time()
   
+  def report_encountered(self,enum_proc):
+    stats = enum_proc.encountered_assemblies_set.stats()
+    print >>stderr,self.timestamp,stats.size,"encountered assemblies remembered",\
+                   "in %d slots," % stats.capacity,\
+                   "load factor %0.3f (fullest stripe %0.3f),"\
+                   % (stats.load_factor,stats.max_stripe_load_factor),\
+                   "%0.2f collisions per lookup"\
+                   % (float(stats.collisions)/max(stats.lookups,1))
+  
   def report_top_output(self,enum_proc,workers=None):
-    self.dict_proc_PID = enum_proc.encountered_assemblies_manager._process.pid
     self.queue_proc_PID = enum_proc.assembly_queue_manager._process.pid
     print >>stderr,'='*80
     subprocess.call('top -n 1 -b | grep PID',shell=True)
-    print >>stderr,'-'*31+'Shared Dict Process'+'-'*30
-    grep_this = '"'+str(self.dict_proc_PID)+' %s"' % self.username
-    subprocess.call('top -n 1 -u %s -b | grep ' % self.username + grep_this,
-                    shell=True)
     if workers is not None:
       print >>stderr,'-'*32+'Worker Processes'+'-'*32
-      proc_PIDs = workers.keys() + [self.queue_proc_PID,self.dict_proc_PID]
+      proc_PIDs = workers.keys() + [self.queue_proc_PID]
       proc_args = ' '.join(['-p'+str(pid) for pid in proc_PIDs])
       subprocess.call('top -n 1 '+proc_args+' -b | grep %s' % self.username,
                       shell=True)
@@ -99,6 +101,16 @@ class EnumerationObserver(object):
     self.time_of_last_report = time.time()
    
  
+  def report_preflight(self,enum_proc):
+    report = enum_proc.preflight_report
+    counts = report.constraint_counts
+    print >>stderr,self.timestamp,"Kept",counts.kept,"of",counts.entries,\
+                   "histogram entries as constraints,",\
+                   counts.kept_above_abs_cutoff,"above absolute frequency cutoff"
+    print >>stderr,self.timestamp,"At most 10^%0.1f of 10^%0.1f topologies "\
+                   "are feasible" % (report.log10_search_space,
+                                     report.log10_topologies)
+  
   def report_score(self,enum_proc):
     if enum_proc.min_score.value > self.old_min_score:
       self.old_min_score = enum_proc.min_score.value
@@ -120,8 +132,12 @@ class EnumerationObserver(object):
      
    
   def __call__(self,enum_proc,workers,interrupt=False):
+    if not self.preflight_reported:
+      self.report_preflight(enum_proc)
+      self.preflight_reported = True
     if self.time_since(self.time_of_last_stamp) > self.timestamp_freq:
       self.report_timestamp()
+      self.report_encountered(enum_proc)
     if self.report_freq is not None:
       if self.first_call or\
                   self.time_since(self.time_of_last_report) > self.report_freq:
@@ -201,6 +217,9 @@ if __name__ == '__main__' and len(argv) > 1:
   workspacesize = 100
   topoffacceptanceratio = 2.0
   topoffacceptancestiffness = 1.0
+  tripletbound = False
+  warmstartbeamwidth = 100
+  encounteredtablesize = 2**22
   outfile = 'aspen_topologies.txt'
 
 #------------------------------------------------------------------------------
@@ -222,7 +241,10 @@ if __name__ == '__main__' and len(argv) > 1:
                                  max_workspace_size=workspacesize,
                                  acceptance_ratio_param=topoffacceptanceratio,
                           acceptance_stiffness_param=topoffacceptancestiffness,
-                                 save_file_name=savefilename)
+                                 save_file_name=savefilename,
+                                 triplet_bound=tripletbound,
+                                 warm_start_beam_width=warmstartbeamwidth,
+                                 encountered_table_size=encounteredtablesize)
   if results is not None:
     write_enumeration_results(results,outfile)
 
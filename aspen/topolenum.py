@@ -5,117 +5,142 @@ import time
 import os
 import math
 import itertools
+import heapq
 import multiprocessing
 import Queue
 import gc
 import tarfile
 from cStringIO import StringIO
-from collections import defaultdict,namedtuple,Hashable
+from collections import defaultdict,namedtuple
+import numpy as np
 from .tree import T_BASE,T
+from .clade import CladeNode
+from .pwhist import load_pwhist,CompiledPWHist
+from .constraints import LPDF,ConstraintCompiler,pair_id,mask_leaves
 from . import fifo
+from . import preflight
+from . import bounds
+from .fingerprints import SharedFingerprintSet
 
 #===============================================================================
 # Topology assembly extension through branching
 #===============================================================================
 
 
-LPDF = namedtuple('LeafPairDistanceFrequency',['leaves','dist','freq'])
-
-
 class ProposedExtension(object):
   
+  # Hundreds of thousands of these can be alive at once, so they have no __dict__
+  __slots__ = ('new_leaf','built_clade','clades','unverified','consistent',
+               'inconsistent','score','nested_set_reprs','clade_masks',
+               'distances_to_root','best_case_terms_delta')
+  
   IndexedPair = namedtuple('IndexedPair',['index','pair'])
   
-  def __init__(self,child1,child2):
-    if any([isinstance(child1,str),isinstance(child2,str)]):
+  def __init__(self,child1,child2,distances_to_root):
+    # Leaves of the clades involved are read off their masks and their distances to
+    # the roots of their clades from distances_to_root, indexed by leaf id
+    if any([isinstance(child1,int),isinstance(child2,int)]):
       # This extension is an attachment of a new leaf to a built clade ...
       # ... so there should be one of each.
-      assert isinstance(child1,str) != isinstance(child2,str)
-      self.new_leaf = child1 if isinstance(child1,str) else child2 # Figure out ...
-      self.built_clade = child2 if isinstance(child1,str) else child1 # .. which is which
+      assert isinstance(child1,int) != isinstance(child2,int)
+      self.new_leaf = child1 if isinstance(child1,int) else child2 # Figure out ...
+      self.built_clade = child2 if isinstance(child1,int) else child1 # .. which is which
       # When a new leaf is attached to a built clade via a new root, the distance between
       # the new leaf and each of the leaves in the built clade will be distance of leaf
       # in existing clade to its current root + 1 to account for the new root
-      self.unverified = dict((frozenset({leaf,self.new_leaf}),
-                                     self.built_clade.clade.trace_dist(leaf)+1
-                              )
-                                    for leaf in self.built_clade.clade.leaf_names
-                             )
+      leaves = mask_leaves(self.built_clade.mask)
+      self.unverified = dict((pair_id(leaf,self.new_leaf),dist+1) for leaf,dist in
+                             itertools.izip(leaves,distances_to_root[leaves].tolist()))
     else: # This extension is the joining of two built clades
       self.clades = sorted([child1,child2],key=lambda x: x.index,reverse=True)
       # When two built clades are joined, the resulting distance between any pair of leaves
       # such that each leaf belongs to a different clade will be
       # sum(distance of each leaf to its current root) + 1 to account for the new root.
-      self.unverified = dict((frozenset({leafpair[0][0],leafpair[1][0]}),
-                                              leafpair[0][1]+leafpair[1][1]+1
-                                     )
-                                    for leafpair
-                                    in itertools.product(*([(leaf,
-                                                             clade.clade.trace_dist(leaf)
-                                                             )
-                                                            for leaf in clade.clade.leaf_names
-                                                            ]
-                                                           for clade in self.clades
-                                                           )
-                                                         )
-                                    )
+      leaf_dists = []
+      for clade in self.clades:
+        leaves = mask_leaves(clade.mask)
+        leaf_dists.append(zip(leaves,distances_to_root[leaves].tolist()))
+      self.unverified = dict((pair_id(leaf1,leaf2),dist1+dist2+1)
+                             for (leaf1,dist1),(leaf2,dist2)
+                             in itertools.product(*leaf_dists))
     self.consistent = {}
-    self.inconsistent = {}
-    self.verified = set()
+    self.inconsistent = []
     self.score = 0.0
   
+  @property
+  def verified(self):
+    # Pairs of leaves on different sides of the new root whose distances have been
+    # checked, either against constraints or against the absolute frequency cutoff
+    if hasattr(self,'new_leaf'):
+      masks = (self.built_clade.mask,1 << self.new_leaf)
+    else:
+      masks = [c.mask for c in self.clades]
+    return {pair_id(leaf1,leaf2) for leaf1 in mask_leaves(masks[0])
+                                 for leaf2 in mask_leaves(masks[1])}-set(self.unverified)
+  
   def check_pair(self,pair,i):
-    if pair.leaves in self.consistent:
+    if pair.pair in self.consistent:
       # If this leaf pair has already been added to consistent, then ...
       # ... it should not be in unverified any more ...
-      assert pair.leaves not in self.unverified
+      assert pair.pair not in self.unverified
       # ... and this new distance should be different from the consistent one ...
-      assert pair.dist != self.consistent[pair.leaves].pair.dist
-      self.inconsistent[i] = pair # ... so it goes into inconsistent
+      assert pair.dist != self.consistent[pair.pair].pair.dist
+      self.inconsistent.append(i) # ... so it goes into inconsistent
     else: # If it hasn't been added to consistent ...
-      if pair.dist == self.unverified[pair.leaves]: # ... and its distance matches expected
-        self.consistent[pair.leaves] = self.IndexedPair(i,pair) # it goes into consistent
+      if pair.dist == self.unverified[pair.pair]: # ... and its distance matches expected
+        self.consistent[pair.pair] = self.IndexedPair(i,pair) # it goes into consistent
         # and is "verified", so pop it from unverified and add to verified
-        self.unverified.pop(pair.leaves)
-        self.verified.add(pair.leaves)
-        self.score += math.log(pair.freq)
+        self.unverified.pop(pair.pair)
+        self.score += pair.logfreq
       else: # ... and its distance doesn't match expected
-        self.inconsistent[i] = pair # it goes into inconsistent ...
+        self.inconsistent.append(i) # it goes into inconsistent ...
         # ... and it remains "unverified", so don't pop it from unverified
   
+  def rebind(self,indexed_clades):
+    # Fresh copy of this extension for another assembly, with the clades it involves
+    # looked up by mask among that assembly's indexed clades
+    copy = type(self).__new__(type(self))
+    if hasattr(self,'new_leaf'):
+      copy.new_leaf = self.new_leaf
+      copy.built_clade = indexed_clades[self.built_clade.mask]
+    else:
+      copy.clades = sorted((indexed_clades[c.mask] for c in self.clades),
+                           key=lambda x: x.index,reverse=True)
+    copy.unverified = dict(self.unverified)
+    copy.consistent = dict(self.consistent)
+    copy.inconsistent = list(self.inconsistent)
+    copy.score = self.score
+    return copy
+  
   def build_extension(self,assemblyobj,in_place=False):
     if not in_place:
       assemblyobj = assemblyobj.copy()
     assert not self.unverified
     
-    # Assemble for removal from constraints_idx indeces of consistent and inconsistent pairdists
-    drop_these = [pair.index for pair in self.consistent.values()]+self.inconsistent.keys()
+    # Assemble for removal from live_constraints indeces of consistent and inconsistent pairdists
+    drop_these = [pair.index for pair in self.consistent.values()]+self.inconsistent
+    assemblyobj.drop_constraints(drop_these)
     
     # Make sure to use clade(s) from this assemblyobj for construction, not the ones from
     # the original that are stored in self.clades
     if hasattr(self,'new_leaf'):
       built_clade = assemblyobj.built_clades.pop(self.built_clade.index)
       assemblyobj.free_leaves.remove(self.new_leaf)
-      assert set(self.built_clade.clade.leaf_names) == set(built_clade.leaf_names)
-      new_clades_attr = [built_clade.wrapped,self.new_leaf]
+      assert self.built_clade.mask == assemblyobj.clade_masks[self.built_clade.index]
+      new_clades_attr = [built_clade,self.new_leaf]
       # One more thing to do if this extension is an attachment of a new leaf:
       # Add for removal constraint pairdists where the new leaf has distance 1 with any
       # other leaf, regardless of whether the other leaf is involved in this extension.
       # All such constraint distances are inconsistent with this extension. This additional
       # check is necessary because of the special way new pair extensions are handled - with
       # no questions asked.
-      drop_these.extend([i for i in assemblyobj.constraints_idx
-                         if self.new_leaf in assemblyobj.constraints_master[i].leaves and
-                                             assemblyobj.constraints_master[i].dist == 1])
+      assemblyobj.drop_constraints(
+                 assemblyobj.constraints_master.by_leaf[self.new_leaf].get(1,[]))
     else:
-      assert all(set(c.clade.leaf_names)==set(assemblyobj.built_clades[c.index].leaf_names)
-                                                            for c in self.clades)
-      new_clades_attr = [assemblyobj.built_clades.pop(c.index).wrapped for c in self.clades]
+      assert all(c.mask == assemblyobj.clade_masks[c.index] for c in self.clades)
+      new_clades_attr = [assemblyobj.built_clades.pop(c.index) for c in self.clades]
     
-    assemblyobj.constraints_idx = filter(lambda x: x not in drop_these,
-                                         assemblyobj.constraints_idx)
-    
-    assemblyobj.built_clades.append(T.requisition(*new_clades_attr))
+    assemblyobj.built_clades.append(CladeNode(*new_clades_attr))
     assemblyobj.recompute(extension=self)
     assemblyobj.score += self.score
     return assemblyobj
@@ -123,7 +148,15 @@ class ProposedExtension(object):
 
 class TreeAssembly(object):
   
-  IndexedClade = namedtuple('IndexedClade',['index','clade'])
+  # Per-instance state. Everything else is either a class attribute (see __init__)
+  # or a property computed from these.
+  __slots__ = ('built_clades','free_leaves','score','_live_constraints',
+               '_dropped_constraints','_nested_set_reprs','_clade_masks',
+               '_distances_to_root','_best_case_terms','_best_case_terms_delta',
+               '_candidates','_parent_candidates','_best_case','_nodes_left_to_build',
+               '_built_nodes_count','_sort_key','_extension_bounds')
+  
+  IndexedClade = namedtuple('IndexedClade',['index','clade','mask'])
   
   class KeyPassingDefaultDict(defaultdict):
     def __missing__(self,key):
@@ -131,7 +164,11 @@ class TreeAssembly(object):
       return self[key]
   
   def __init__(self,pwleafdist_histograms,constraint_freq_cutoff,leaves_to_assemble,
-               absolute_freq_cutoff=0.01,keep_alive_when_pickling=True):
+               absolute_freq_cutoff=0.01,keep_alive_when_pickling=True,
+               triplet_bound=False):
+    # keep_alive_when_pickling no longer does anything, since built clades are
+    # always rebuilt from their encoding when unpickling, and is only kept so that
+    # positional arguments keep their meaning
     #===========================================================================
     # The data attributes below will are set on the class, not in instances,
     # meaning they will be shared between all instances of this class, saving
@@ -139,120 +176,260 @@ class TreeAssembly(object):
     # *** The are INVARIANTS and should not be changed by instances!!! ***
     #===========================================================================
     
-    # Make a sorted master reference tuple of pw distance freq constraints, ...
-    type(self).constraints_master = tuple(sorted([
-                                            # by creating LPDF tuples ...
-                                            LPDF(pair_histogram[0],score[0],score[1])
-                                            # for every histogram of pw distances for a leaf pair ...
-                                            for pair_histogram in
-                                            # present in a built-on-the-fly subset of
-                                            # the full histogram for that pair ...
-        [(leafpair,[dist for i,dist in enumerate(distances) if
-                    # of distances ordered by freq such that the sum of their freqs
-                    # is less than the requested frequency cutoff, ...
-                    sum(d[1] for d in distances[:i]) < constraint_freq_cutoff]
-          ) for leafpair,distances in pwleafdist_histograms]
-                                            for score in pair_histogram[1]],
-                                           # sorted on (shortest dist, highest freq)
-                                           key=lambda x: (x.dist,1-x.freq)
-                                                 )
-                                          )
+    # Leaves are interned as integer ids, numbered in the sorted order of their
+    # names, and leaf pairs as canonical pair indeces (see pair_id). Assembly
+    # works on these alone; names are only used again when writing topologies.
+    type(self).leaf_names = tuple(sorted(leaves_to_assemble))
+    type(self).leaf_ids = {leaf:i for i,leaf in enumerate(type(self).leaf_names)}
+    type(self).pair_leaves = tuple((leaf1,leaf2) for leaf2 in xrange(len(self.leaf_names))
+                                                 for leaf1 in xrange(leaf2))
+    # Histograms are worked on as flat arrays of the distances and frequencies of
+    # all their entries, with the entries of the i-th pair running from offsets[i]
+    # to offsets[i+1]. A compiled histogram file already holds them that way.
+    if isinstance(pwleafdist_histograms,CompiledPWHist):
+      file_leaf_ids = np.array([self.leaf_ids[leaf]
+                                for leaf in pwleafdist_histograms.leaf_names],dtype=int)
+      leaf1,leaf2 = file_leaf_ids[pwleafdist_histograms.pair_leaves].T
+      offsets = pwleafdist_histograms.offsets
+      dists = pwleafdist_histograms.dists
+      freqs = pwleafdist_histograms.freqs
+    else:
+      leaf1,leaf2,offsets,dists,freqs = [],[],[0],[],[]
+      for leafpair,distances in pwleafdist_histograms:
+        pair_leaf1,pair_leaf2 = (self.leaf_ids[leaf] for leaf in leafpair)
+        leaf1.append(pair_leaf1)
+        leaf2.append(pair_leaf2)
+        for dist,freq in distances:
+          dists.append(dist)
+          freqs.append(freq)
+        offsets.append(len(dists))
+      leaf1,leaf2 = np.array(leaf1,dtype=int),np.array(leaf2,dtype=int)
+      offsets = np.array(offsets,dtype=int)
+      dists,freqs = np.array(dists,dtype=int),np.array(freqs,dtype=float)
+    # Same as pair_id, for all pairs at once
+    interned_pairs = np.maximum(leaf1,leaf2)*(np.maximum(leaf1,leaf2)-1)//2+\
+                     np.minimum(leaf1,leaf2)
+    if len(np.unique(interned_pairs)) != len(self.pair_leaves):
+      raise ValueError("Histograms must be provided for every pair of leaves")
+    
+    # Dense table of log frequencies indexed by pair and distance, with -inf for
+    # distances never observed for a pair, wide enough for any distance possible
+    # between the leaves. Scoring looks frequencies up here instead of taking logs.
+    max_dist = max(len(self.leaf_names)-1,int(dists.max()) if len(dists) else 0)
+    log_freq_table = np.empty((len(self.pair_leaves),max_dist+1))
+    log_freq_table.fill(-np.inf)
+    observed = np.flatnonzero(freqs > 0)
+    log_freq_table[np.repeat(interned_pairs,np.diff(offsets))[observed],
+                   dists[observed]] = np.log(freqs[observed])
+    log_freq_table.flags.writeable = False
+    type(self).log_freq_table = log_freq_table
+    # Same table as nested lists, which are faster for looking up single entries
+    type(self).log_freqs = log_freq_table.tolist()
+    pair_leaf_ids = np.array(self.pair_leaves,dtype=int).reshape(len(self.pair_leaves),2)
+    pair_leaf_ids.flags.writeable = False
+    type(self).pair_leaf_ids = pair_leaf_ids
+    # Ids of the pairs each leaf is in, indexed by leaf id
+    type(self).pairs_of_leaf = [np.array(sorted(pair_id(leaf,other)
+                                                for other in xrange(len(self.leaf_names))
+                                                if other != leaf),dtype=int)
+                                for leaf in xrange(len(self.leaf_names))]
     
-    # Unlike constraints_master, which guarantees invariance by being recursively immutable,
-    # this is a mutable dict. Is there a way to force immutability?
-    type(self).pwdist_histograms_dict = {leafpair:dict(dist_histogram)
-                                         for leafpair,dist_histogram in pwleafdist_histograms}
+    # Master reference table of pw distance freq constraints, sorted on
+    # (shortest dist, highest freq)
+    constraint_compiler = ConstraintCompiler.from_arrays(interned_pairs,offsets,dists,freqs)
+    type(self).constraints_master = constraint_compiler.compile(constraint_freq_cutoff,
+                                                                self.pair_leaves,
+                                                                self.log_freq_table)
+    
+    # Highest log frequency of each pair at or beyond each distance, with an extra
+    # column of -inf for distances beyond any observed. The best case score is
+    # gathered from here by the least distance still possible for each pair.
+    best_log_freq_beyond = np.empty((len(self.pair_leaves),max_dist+2))
+    best_log_freq_beyond[:,-1] = -np.inf
+    best_log_freq_beyond[:,-2::-1] = np.maximum.accumulate(log_freq_table[:,::-1],axis=1)
+    # Two leaves only end up in a cherry together as a new pair, which takes a
+    # distance 1 constraint between them, and such a constraint is never dropped
+    # while both leaves are free. Pairs without one can't be at distance less than
+    # 2, whatever else is built, and if that is all they were observed at, no
+    # assembly with both leaves free can be completed.
+    cherries = np.zeros(len(self.pair_leaves),dtype=bool)
+    cherries[self.constraints_master.pair[self.constraints_master.dist == 1]] = True
+    # Cherries sharing a leaf are mutually exclusive, so only a matching of free
+    # leaves can take the distance 1 frequencies. Pairs that can be cherries are
+    # bounded as if they weren't, and what each could add as a cherry on top of
+    # that is bounded per leaf instead (see cherry_terms_for). Forced cherries,
+    # pairs never observed beyond distance 1, keep their own bound.
+    forced = cherries & np.isneginf(best_log_freq_beyond[:,2])
+    cherry_bonus = np.zeros(len(self.pair_leaves))
+    bonus_rows = cherries & ~forced
+    cherry_bonus[bonus_rows] = best_log_freq_beyond[bonus_rows,1]-\
+                               best_log_freq_beyond[bonus_rows,2]
+    best_log_freq_beyond[~forced,1] = best_log_freq_beyond[~forced,2]
+    best_log_freq_beyond.flags.writeable = False
+    type(self).best_log_freq_beyond = best_log_freq_beyond
+    # Cherry compatibility of leaves as (leaf x leaf) tables of what each cherry
+    # could add and of forced cherries, and the leaves whose cherry terms change
+    # when each leaf stops being free: itself and its possible cherry partners
+    num_leaves = len(self.leaf_names)
+    leaf1,leaf2 = self.pair_leaf_ids[:,0],self.pair_leaf_ids[:,1]
+    cherry_bonuses = np.zeros((num_leaves,num_leaves))
+    cherry_bonuses[leaf1,leaf2] = cherry_bonuses[leaf2,leaf1] = cherry_bonus
+    forced_cherries = np.zeros((num_leaves,num_leaves),dtype=bool)
+    forced_cherries[leaf1,leaf2] = forced_cherries[leaf2,leaf1] = forced
+    for table in (cherry_bonuses,forced_cherries):
+      table.flags.writeable = False
+    type(self).cherry_bonuses = cherry_bonuses
+    type(self).forced_cherries = forced_cherries
+    type(self).cherry_neighbors = [np.union1d([leaf],np.flatnonzero(
+                                     (cherry_bonuses[leaf] > 0) | forced_cherries[leaf]))
+                                   for leaf in xrange(num_leaves)]
+    # Optionally, disjoint triplets of leaves whose pairs can't all be at their best
+    # distances in one tree, and how much that costs each of them, while all three
+    # leaves are free (see bounds.py). A pair of free leaves is bounded by column 1
+    # of best_log_freq_beyond, or as a cherry by that plus what the cherry adds.
+    if triplet_bound:
+      pair_log_freqs = np.hstack((np.zeros((len(self.pair_leaves),1)),
+                                  best_log_freq_beyond[:,1:2],log_freq_table[:,2:]))
+      pair_log_freqs[:,0] = -np.inf
+      pair_log_freqs[~cherries,1] = -np.inf
+      triplet_leaves,triplet_gains = bounds.pack_triplets(
+                                   *bounds.triplet_gains(pair_log_freqs,num_leaves))
+    else:
+      triplet_leaves,triplet_gains = np.zeros((0,3),dtype=int),np.zeros(0)
+    triplet_of_leaf = np.empty(num_leaves,dtype=int)
+    triplet_of_leaf.fill(-1)
+    for i,leaves in enumerate(triplet_leaves.tolist()):
+      triplet_of_leaf[leaves] = i
+    for table in (triplet_leaves,triplet_gains,triplet_of_leaf):
+      table.flags.writeable = False
+    type(self).triplet_leaves = triplet_leaves
+    type(self).triplet_gains = triplet_gains
+    type(self).triplet_of_leaf = triplet_of_leaf
+    # The triplet bound also bounds pairs between built clades jointly (see
+    # share_distances), whose units are numbered up to new_unit (see leaf_units)
+    type(self).triplet_bound = triplet_bound
+    type(self).new_unit = 2*num_leaves
     
     # More technically mutable variables that should not be changed by instances
     type(self).abs_cutoff = absolute_freq_cutoff
-    type(self).leaves_master = set(leaves_to_assemble)
-    type(self).pickle_encoding = {chr(i):t for i,t in enumerate('[],;')}
-    type(self).pickle_encoding.update({chr(i+4):repr(l) for i,l in
-                                       enumerate(type(self).leaves_master)})
+    type(self).log_abs_cutoff = math.log(absolute_freq_cutoff) if absolute_freq_cutoff > 0\
+                                                                   else -np.inf
+    type(self).leaves_master = set(xrange(len(self.leaf_names)))
+    # Leaves are encoded by one character when pickling, or by two if there are
+    # too many of them, following the two characters marking clade boundaries
+    type(self).leaf_code_width = 1 if len(self.leaf_names) <= 254 else 2
+    if self.leaf_code_width == 1:
+      type(self).leaf_codes = tuple(chr(i+2) for i in self.leaves_master)
+    else:
+      type(self).leaf_codes = tuple(chr(i//256+2)+chr(i%256) for i in self.leaves_master)
+    type(self).leaf_code_ids = {code:i for i,code in enumerate(self.leaf_codes)}
     type(self).total_nodes_to_build = len(leaves_to_assemble) - 1
-    type(self).best_possible = sum(math.log(max(p[1],key=lambda x: x[1])[1])
-                                   for p in pwleafdist_histograms)
-    type(self).keep_alive = keep_alive_when_pickling
+    type(self).best_possible = sum(max(log_freqs) for log_freqs in self.log_freqs)
     
     #===========================================================================
     # END of class attributes
     #===========================================================================
     
     self.built_clades = []
-    self.free_leaves = set(leaves_to_assemble)
-    self.constraints_idx = range(len(self.constraints_master))
+    self.free_leaves = set(self.leaves_master)
+    # Live constraints are marked in a boolean mask over constraints_master
+    self._live_constraints = np.ones(len(self.constraints_master),dtype=bool)
+    self._dropped_constraints = []
     self.score = 0.0
   
-  def rebuild_constraints_idx(self):
-    self.constraints_idx = [i for i,_ in enumerate(self.constraints_master)]
-    intra_clade_pairs = [frozenset(p) for c in self.built_clades for p in
-                                        itertools.combinations(c.leaf_names,2)]
-    drop_these_idx = [i for i,d in enumerate(self.constraints_master)
-                                        if d.leaves in intra_clade_pairs][::-1]
-    for i in drop_these_idx:
-      self.constraints_idx.pop(i)
-    l_accounted_for = set.union(*[set(leafset) for leafset in
-                                                     self.pairs_accounted_for])
-    drop_these_idx = [idx for idx,i in enumerate(self.constraints_idx)
-                      if self.constraints_master[i].dist == 1 and
-                      self.constraints_master[i].leaves & l_accounted_for][::-1]
-    for i in drop_these_idx:
-      self.constraints_idx.pop(i)
-  
-  def convert_containers(self,convert_this,container_type=None):
-    result = []
-    for member in convert_this:
-      if isinstance(member,Hashable) and member in self.leaves_master:
-        result.append(member)
-      else:
-        result.append(self.convert_containers(member,container_type))
-    if container_type is not None:
-      return container_type(result)
-    else:
-      return result
+  def built_leaves(self):
+    return {leaf for c in self.built_clades for leaf in c.leaves}
+  
+  def clade_of_leaf(self):
+    # Index of the built clade of each leaf, or -1 for free leaves
+    clade_of_leaf = np.empty(len(self.leaf_names),dtype=int)
+    clade_of_leaf.fill(-1)
+    for i,mask in enumerate(self.clade_masks):
+      clade_of_leaf[mask_leaves(mask)] = i
+    return clade_of_leaf
+  
+  def leaf_units(self):
+    # Index of the built clade of each leaf, or for free leaves, the number of
+    # leaves plus the leaf's id, so that each built clade and each free leaf is a
+    # unit of its own. new_unit is left for the clade an extension builds.
+    units = self.clade_of_leaf()
+    free = units < 0
+    units[free] = len(self.leaf_names)+np.flatnonzero(free)
+    return units
+  
+  def rebuild_live_constraints(self):
+    # Constraints are live unless both leaves are in the same built clade, or the
+    # distance is 1 and either leaf is in a built clade
+    clade_of_leaf = self.clade_of_leaf()
+    constraints = self.constraints_master
+    clade1,clade2 = clade_of_leaf[constraints.leaf1],clade_of_leaf[constraints.leaf2]
+    self._live_constraints = ~(((clade1 == clade2) & (clade1 >= 0)) |
+                               ((constraints.dist == 1) & ((clade1 >= 0) | (clade2 >= 0))))
+    self._dropped_constraints = []
   
-  def __getstate__(self):
-    state = {'score':self.score}
-    if self.keep_alive:
-      state['built_clades'] = [c.check_in_pickle() for c in self.built_clades]
+  @property
+  def live_constraints(self):
+    # Arrays assigned to _live_constraints are shared between an assembly and those
+    # extended from it, and are never changed in place. Constraints dropped by an
+    # extension are only recorded (see drop_constraints), and applied to a copy of
+    # the shared array when the assembly's own live constraints are needed.
+    if self._dropped_constraints:
+      live_constraints = self._live_constraints.copy()
+      for constraint_ids in self._dropped_constraints:
+        live_constraints[constraint_ids] = False
+      self._live_constraints = live_constraints
+      self._dropped_constraints = []
+    return self._live_constraints
+  
+  def drop_constraints(self,constraint_ids):
+    self._dropped_constraints.append(constraint_ids)
+  
+  @classmethod
+  def encode_clade(cls,clade_repr):
+    # Clades are given as nested frozensets of leaf ids
+    if isinstance(clade_repr,frozenset):
+      return '\x00'+''.join(cls.encode_clade(m) for m in clade_repr)+'\x01'
     else:
-      state['built_clades'] = [T._nsrepr(c) for c in self.built_clades]
-    state['built_clades'] = ';'.join(''.join(repr(
-                                          self.convert_containers(c)).split())
-                                     for c in state['built_clades'])
-    for k,v in self.pickle_encoding.items():
-      state['built_clades'] = state['built_clades'].replace(v,k)
-    return state['built_clades'],state['score'],self.best_case,\
-                                                       self.nodes_left_to_build
+      return cls.leaf_codes[clade_repr]
   
-  def _unpack_state(self,state):
-    s = StringIO(state[0])
+  @classmethod
+  def decode_clades(cls,encoded):
     clades = []
-    while True:
-      read_byte = s.read(1)
-      if not read_byte:
-        break
+    members_stack = [clades]
+    i = 0
+    while i < len(encoded):
+      if encoded[i] == '\x00':
+        members_stack.append([])
+        i += 1
+      elif encoded[i] == '\x01':
+        members = members_stack.pop()
+        members_stack[-1].append(frozenset(members))
+        i += 1
       else:
-        clades.append(self.pickle_encoding[read_byte])
+        members_stack[-1].append(cls.leaf_code_ids[encoded[i:i+cls.leaf_code_width]])
+        i += cls.leaf_code_width
+    return clades
+  
+  def __getstate__(self):
+    encoded_clades = ''.join(self.encode_clade(c.nested_set_repr()) for c in self.built_clades)
+    return encoded_clades,self.score,self.best_case,self.nodes_left_to_build,self.sort_key
+  
+  def _unpack_state(self,state):
+    # States of assemblies reloaded from a save have no sort key (see
+    # RestartQueueReloader), which is then computed when first needed
     return {'score':state[1],'_best_case':state[2],'_nodes_left_to_build':state[3],
-            'built_clades':[self.convert_containers(eval(m),frozenset)
-                            for m in ''.join(clades).split(';')]}
+            '_sort_key':state[4] if len(state) > 4 else None,
+            'built_clades':self.decode_clades(state[0])}
   
   def __setstate__(self,state):
     state = self._unpack_state(state)
     for k,v in state.items():
       if k != 'built_clades':
-        self.__dict__[k] = v
-    if self.keep_alive:
-      self.__dict__['built_clades'] = [T.check_out_pickle(k)
-                                       for k in state['built_clades']]
-    else:
-      self.__dict__['built_clades'] = [T.rebuild_on_unpickle(clade_repr)
-                                       for clade_repr in state['built_clades']]
-    self.free_leaves = self.leaves_master -\
-                          set.union(*[set(leafset) for leafset in
-                                                     self.pairs_accounted_for])
-    self.rebuild_constraints_idx()
+        setattr(self,k,v)
+    self.built_clades = [CladeNode.from_nested_set(clade_repr)
+                         for clade_repr in state['built_clades']]
+    self.free_leaves = self.leaves_master - self.built_leaves()
+    self.rebuild_live_constraints()
   
   def compress(self):
     return self.__getstate__()
@@ -264,37 +441,78 @@ class TreeAssembly(object):
     return obj
   
   def copy(self):
+    # Arrays over all pairs or all constraints are shared with the copy, which only
+    # records its changes to them (see live_constraints and best_case_terms), so a
+    # copy costs memory in proportion to the number of leaves
     copy_of_self = type(self).__new__(type(self))
-    copy_of_self._nested_set_reprs = [r for r in self._nested_set_reprs]
-    copy_of_self._distances_to_root = {k:v for k,v in self._distances_to_root.iteritems()}
+    copy_of_self._nested_set_reprs = [r for r in self.current_clades_as_nested_sets]
+    copy_of_self._clade_masks = [m for m in self.clade_masks]
+    copy_of_self._distances_to_root = self.distances_to_root.copy()
     copy_of_self.free_leaves = {fl for fl in self.free_leaves}
     copy_of_self.score = self.score
-    copy_of_self._pairs_accounted_for = {p for p in self._pairs_accounted_for}
+    copy_of_self._best_case_terms = self.best_case_terms
     copy_of_self.built_clades = [bc for bc in self.built_clades]
-    copy_of_self.constraints_idx = [c for c in self.constraints_idx]
+    copy_of_self._live_constraints = self._live_constraints
+    copy_of_self._dropped_constraints = [ids for ids in self._dropped_constraints]
     return copy_of_self
   
   def recompute(self,*args,**kwargs):
     if 'extension' in kwargs:
       extension = kwargs['extension']
       if type(extension).__name__ == 'LeafPairDistanceFrequency':
-        for leaf in extension.leaves:
-          self._distances_to_root[leaf] = 1
-        self._pairs_accounted_for.add(extension.leaves)
+        self._distances_to_root[list(extension.leaves)] = 1
+        changed_pairs = self.pairs_of_leaves(extension.leaves)
+        changed_leaf_terms = self.free_leaf_term_ids(extension.leaves)
+        units = None
+        if self.triplet_bound:
+          units = self.leaf_units()
+          units[list(extension.leaves)] = self.new_unit
+        self._best_case_terms_delta = (self.best_case_terms,
+                                       np.concatenate((changed_pairs,len(self.pair_leaves)+
+                                                                    changed_leaf_terms)),
+                                       np.concatenate((self.best_case_terms_for(
+                                                         changed_pairs,
+                                                         changed_pairs == extension.pair,
+                                                         units=units),
+                                                       self.free_leaf_terms_for(
+                                                         changed_leaf_terms))))
+        del self._best_case_terms
         self._nested_set_reprs.append(frozenset({frozenset(extension.leaves),'r'}))
+        self._clade_masks.append(extension.mask)
       else:
         self._distances_to_root = extension.distances_to_root
-        self._pairs_accounted_for = extension.pairs_accounted_for
+        self._pop('_best_case_terms')
+        self._best_case_terms_delta = extension.best_case_terms_delta
         self._nested_set_reprs = extension.nested_set_reprs
+        self._clade_masks = extension.clade_masks
     else:
       if '_distances_to_root' in args:
-        self._distances_to_root = {leaf:clade.trace_dist(leaf) for clade in self.built_clades
-                                   for leaf in clade.leaf_names}
-      if '_pairs_accounted_for' in args:
-        self._pairs_accounted_for = {frozenset(pair) for clade in self.built_clades
-                                     for pair in itertools.combinations(clade.leaf_names,2)}
+        self._distances_to_root = np.zeros(len(self.leaf_names),dtype=int)
+        for clade in self.built_clades:
+          for leaf,depth in clade.leaf_depths():
+            self._distances_to_root[leaf] = depth
+      if '_best_case_terms' in args:
+        if hasattr(self,'_best_case_terms_delta'):
+          terms,changed_pairs,changed_terms = self._pop('_best_case_terms_delta')
+          self._best_case_terms = terms.copy()
+          self._best_case_terms[changed_pairs] = changed_terms
+        else:
+          self._best_case_terms = self.all_best_case_terms()
       if '_nested_set_reprs' in args:
         self._nested_set_reprs = [frozenset({c.nested_set_repr(),'r'}) for c in self.built_clades]
+      if '_clade_masks' in args:
+        self._clade_masks = [c.mask for c in self.built_clades]
+      if '_candidates' in args:
+        self._candidates = self.tally_candidates(self._pop('_parent_candidates'))
+  
+  def _pop(self,attribute):
+    # Unsets attribute, returning its value, or None if it wasn't set
+    try:
+      value = getattr(self,attribute)
+    except AttributeError:
+      return None
+    delattr(self,attribute)
+    return value
   
   def _property_getter(self,property):
     try:
@@ -307,37 +525,66 @@ class TreeAssembly(object):
   def current_clades_as_nested_sets(self):
     return self._property_getter('_nested_set_reprs')
   
+  @property
+  def clade_masks(self):
+    # Leaf sets of built clades as bitmasks over leaf ids
+    return self._property_getter('_clade_masks')
+  
   @property
   def distances_to_root(self):
+    # Number of internal nodes between each leaf and the root of its clade, indexed
+    # by leaf id, and 0 for free leaves
     return self._property_getter('_distances_to_root')
   
   @property
   def pairs_accounted_for(self):
-    return self._property_getter('_pairs_accounted_for')
+    # Boolean mask over pair ids of pairs already in the same built clade. It is
+    # computed from the clades when needed, instead of being kept with every assembly.
+    clade_of_leaf = self.clade_of_leaf()
+    clade1,clade2 = clade_of_leaf[self.pair_leaf_ids[:,0]],clade_of_leaf[self.pair_leaf_ids[:,1]]
+    return (clade1 == clade2) & (clade1 >= 0)
+  
+  @property
+  def num_pairs_accounted_for(self):
+    return sum(n*(n-1)//2 for n in (bin(mask).count('1') for mask in self.clade_masks))
+  
+  @property
+  def best_case_terms(self):
+    # What each pair adds to the best case score, indexed by pair id (see
+    # best_case_terms_for), followed by the terms of free leaves (see
+    # free_leaf_terms_for). Extensions only recompute the terms of pairs involving
+    # leaves whose distances to root they change, and of leaves near those they
+    # take out of the free pool, and keep them as a delta over the terms of the
+    # assembly they extend until their own terms are needed. Like live
+    # constraints, the arrays are shared and never changed in place.
+    return self._property_getter('_best_case_terms')
   
   @property
   def complete(self):
     return len(self.built_clades) == 1 and not self.free_leaves
   
+  def materialize(self):
+    return self
+  
+  def as_newick(self):
+    # Bio.Phylo clades are only built for writing topologies out
+    return T.rebuild_on_unpickle(self.built_clades[0].nested_set_repr()).write_renamed(
+                                                   self.leaf_names.__getitem__,
+                                                   'as_string',format='newick',
+                                                   plain=True)
+  
   def verify_remaining_proposed_pairs(self,extensions):
     for key,ext in extensions.items():
       for pair,dist in ext.unverified.items():
-        # Looking up pair histogram separately in case lookup throws KeyError,
-        # since we don't want to catch that one
-        pair_histogram = self.pwdist_histograms_dict[pair]
-        try:
-          pair_freq = pair_histogram[dist]
-        except KeyError:
-          # If the resulting pairdist is not in the histogram, it means it wasn't observed
-          # at all, so it's frequency is 0.
-          pair_freq = 0.0
-        if pair_freq < self.abs_cutoff:
+        # If the resulting pairdist is not in the histogram, it means it wasn't observed
+        # at all, so its log frequency is -inf.
+        pair_log_freq = self.log_freqs[pair][dist]
+        if pair_log_freq < self.log_abs_cutoff:
           extensions.pop(key)
           break
         else:
-          ext.score += math.log(pair_freq)
+          ext.score += pair_log_freq
           ext.unverified.pop(pair)
-          ext.verified.add(pair)
       else:
         # If all unverified pairs check out, make sure this extension is not passing
         # this filter entirely on the strength of pairs we just verified
@@ -357,15 +604,20 @@ class TreeAssembly(object):
       if hasattr(extension,'built_clade'):
         new_clade = frozenset({frozenset({extension.built_clade.clade.nested_set_repr(),
                                           extension.new_leaf}),'r'})
+        new_clade_mask = extension.built_clade.mask | 1 << extension.new_leaf
         indeces_to_skip = {extension.built_clade.index}
       else:
         new_clade = frozenset({frozenset(c.clade.nested_set_repr()
                                          for c in extension.clades),
                                'r'})
+        new_clade_mask = extension.clades[0].mask | extension.clades[1].mask
         indeces_to_skip = {c.index for c in extension.clades}
       extension.nested_set_reprs = [c for i,c in enumerate(self.current_clades_as_nested_sets)
                                     if i not in indeces_to_skip]
       extension.nested_set_reprs.append(new_clade)
+      extension.clade_masks = [m for i,m in enumerate(self.clade_masks)
+                               if i not in indeces_to_skip]
+      extension.clade_masks.append(new_clade_mask)
     
     clades = [c for i,c in enumerate(self.current_clades_as_nested_sets)
                            if i not in indeces_to_skip]
@@ -398,189 +650,537 @@ class TreeAssembly(object):
     self._best_case = None
     self._nodes_left_to_build = None
     self._built_nodes_count = None
+    self._sort_key = None
+  
+  @classmethod
+  def priority(cls,score,best_case,nodes_left_to_build,num_pairs_accounted_for):
+    # Workspace ordering key of an assembly with the given score, best case and
+    # number of nodes left to build
+    built_nodes_count = cls.total_nodes_to_build-nodes_left_to_build
+    return cls.best_possible + score/max(num_pairs_accounted_for,1) if\
+      float(built_nodes_count)/cls.total_nodes_to_build < 0.4 else\
+      best_case/built_nodes_count
   
   @property
   def sort_key(self):
-    return self.best_possible + self.score/len(self.pairs_accounted_for) if\
-      float(self.built_nodes_count)/self.total_nodes_to_build < 0.4 else\
-      self.best_case/self.built_nodes_count
+    # Workspaces sort their whole cache of assemblies by this key every iteration,
+    # so it is computed once per assembly, and kept in its compressed state
+    if not hasattr(self,'_sort_key') or self._sort_key is None:
+      self._sort_key = self.priority(self.score,self.best_case,self.nodes_left_to_build,
+                                     self.num_pairs_accounted_for)
+    return self._sort_key
   
   def calculate_best_case(self,pairs_accounted_for=None,distances_to_root=None,
                      score=None):
-    pairs_accounted_for = pairs_accounted_for or self.pairs_accounted_for
-    distances_to_root = distances_to_root or self.distances_to_root
-    best_possible_final_score = score or self.score
-    for pair,histogram in self.pwdist_histograms_dict.items():
-      if pair not in pairs_accounted_for:
-        min_dist = sum(distances_to_root[leaf] if leaf in distances_to_root else
-                       0 for leaf in pair)+1
-        acceptable_dist_freqs = [freq for dist,freq in histogram.items()
-                                 if dist >= min_dist]
-        if acceptable_dist_freqs:
-          best_possible_final_score += math.log(max(acceptable_dist_freqs))
-        else:
-          return None
-    return best_possible_final_score
+    if pairs_accounted_for is None and distances_to_root is None:
+      terms = self.best_case_terms
+    else:
+      terms = self.all_best_case_terms(pairs_accounted_for,distances_to_root)
+    score = self.score if score is None else score
+    return self.bounds([score],terms[np.newaxis])[0].item()
+  
+  def best_case_terms_for(self,pairs,accounted=None,distances_to_root=None,rows=None,
+                          units=None):
+    # Each pair not yet accounted for adds the highest log frequency at or beyond the
+    # least distance it can still end up at, except that of cherries, which are
+    # bounded per leaf (see cherry_terms_for), and pairs accounted for add nothing.
+    # accounted marks which of the pairs are accounted for. If rows are given,
+    # distances_to_root holds a batch of assemblies, and the term of each pair is
+    # taken from the corresponding row. With the triplet bound, pairs are bounded
+    # jointly by the units (see leaf_units) of their leaves, if given, in the same
+    # way as distances to root.
+    if accounted is None:
+      accounted = self.pairs_accounted_for[pairs]
+    if distances_to_root is None:
+      distances_to_root = self.distances_to_root
+    pair_leaves = self.pair_leaf_ids[pairs]
+    if rows is None:
+      min_dists = distances_to_root[pair_leaves[:,0]]+distances_to_root[pair_leaves[:,1]]+1
+    else:
+      min_dists = distances_to_root[rows,pair_leaves[:,0]]+\
+                                            distances_to_root[rows,pair_leaves[:,1]]+1
+    np.minimum(min_dists,self.best_log_freq_beyond.shape[1]-1,out=min_dists)
+    terms = self.best_log_freq_beyond[pairs,min_dists]
+    terms[accounted] = 0.0
+    if units is not None and self.triplet_bound:
+      self.share_distances(terms,pairs,accounted,distances_to_root,units,rows)
+    return terms
+  
+  def share_distances(self,terms,pairs,accounted,distances_to_root,units,rows=None):
+    # Built clades only get new nodes above their roots, so all pairs between two
+    # units, where at least one is a built clade, end up at the distances of their
+    # leaves to their roots plus one and the same distance between the units (see
+    # bounds.py). Their terms are replaced, in place, by the most they can add
+    # together, taken by the pair of each two units with the lowest position.
+    pair_leaves = self.pair_leaf_ids[pairs]
+    if rows is None:
+      depths = distances_to_root[pair_leaves]
+      pair_units = units[pair_leaves]
+      keys = np.zeros(len(pairs),dtype=int)
+    else:
+      depths = distances_to_root[rows[:,np.newaxis],pair_leaves]
+      pair_units = units[rows[:,np.newaxis],pair_leaves]
+      keys = rows
+    grouped = np.flatnonzero(~np.asarray(accounted) & (depths > 0).any(axis=1))
+    if not len(grouped):
+      return
+    pair_units.sort(axis=1)
+    num_units = self.new_unit+1
+    keys = (keys[grouped]*num_units+pair_units[grouped,0])*num_units+pair_units[grouped,1]
+    order = np.argsort(keys,kind='mergesort')
+    grouped,keys = grouped[order],keys[order]
+    starts = np.flatnonzero(np.concatenate(([True],keys[1:] != keys[:-1])))
+    joint = bounds.shared_distance_bounds(self.log_freq_table,np.asarray(pairs)[grouped],
+                                          depths[grouped].sum(axis=1),starts)
+    terms[grouped] = 0.0
+    terms[grouped[starts]] = joint
+  
+  def cherry_terms_for(self,leaves,distances_to_root=None,rows=None):
+    # Each free leaf adds half of the most the cherry with any other free leaf could
+    # add, so that a matching of free leaves adds no more than its cherries can. A
+    # free leaf with a free forced cherry partner can't be in any other cherry and
+    # adds nothing, and one with more than one can't be completed at all. Leaves
+    # in built clades add nothing. rows are as in best_case_terms_for.
+    if distances_to_root is None:
+      distances_to_root = self.distances_to_root
+    free = distances_to_root == 0
+    if rows is None:
+      leaf_free = free[leaves]
+    else:
+      free = free[rows]
+      leaf_free = free[np.arange(len(leaves)),leaves]
+    terms = np.where(free,self.cherry_bonuses[leaves],0.0).max(axis=1)/2
+    forced = (self.forced_cherries[leaves] & free).sum(axis=1)
+    terms[forced > 0] = 0.0
+    terms[forced > 1] = -np.inf
+    terms[~leaf_free] = 0.0
+    return terms
+  
+  def triplet_terms_for(self,triplets,distances_to_root=None,rows=None):
+    # Each packed triplet takes off what it costs while all three of its leaves are
+    # free, and nothing otherwise. rows are as in best_case_terms_for.
+    if distances_to_root is None:
+      distances_to_root = self.distances_to_root
+    leaves = self.triplet_leaves[triplets]
+    if rows is None:
+      depths = distances_to_root[leaves]
+    else:
+      depths = distances_to_root[rows[:,np.newaxis],leaves]
+    return np.where((depths == 0).all(axis=1),-self.triplet_gains[triplets],0.0)
+  
+  def free_leaf_terms_for(self,term_ids,distances_to_root=None,rows=None):
+    # Terms of free leaves, by id among them: cherry terms by leaf id, followed by
+    # triplet terms by packed triplet index
+    term_ids = np.asarray(term_ids,dtype=int)
+    cherry = term_ids < len(self.leaf_names)
+    cherry_rows,triplet_rows = (None,None) if rows is None else (rows[cherry],rows[~cherry])
+    terms = np.empty(len(term_ids))
+    terms[cherry] = self.cherry_terms_for(term_ids[cherry],distances_to_root,cherry_rows)
+    terms[~cherry] = self.triplet_terms_for(term_ids[~cherry]-len(self.leaf_names),
+                                            distances_to_root,triplet_rows)
+    return terms
+  
+  def all_best_case_terms(self,pairs_accounted_for=None,distances_to_root=None):
+    # Pairs are only bounded jointly for the assembly's own clades
+    units = self.leaf_units() if pairs_accounted_for is None and\
+                                 distances_to_root is None and self.triplet_bound else None
+    if pairs_accounted_for is None:
+      pairs_accounted_for = self.pairs_accounted_for
+    return np.concatenate((self.best_case_terms_for(np.arange(len(self.pair_leaves)),
+                                                    pairs_accounted_for,distances_to_root,
+                                                    units=units),
+                           self.free_leaf_terms_for(np.arange(len(self.leaf_names)+
+                                                              len(self.triplet_leaves)),
+                                                    distances_to_root)))
+  
+  def free_leaf_term_ids(self,leaves):
+    # Sorted ids of the terms of free leaves that change when the leaves stop being
+    # free: cherry terms of the leaves and their possible cherry partners, and
+    # terms of the triplets they are packed in
+    leaves = list(leaves)
+    triplets = self.triplet_of_leaf[leaves]
+    return np.unique(np.concatenate([self.cherry_neighbors[leaf] for leaf in leaves]+
+                                    [len(self.leaf_names)+triplets[triplets >= 0]]))
+  
+  def bounds(self,scores,terms):
+    # Best case scores of a batch of assemblies, given as their scores and rows of
+    # best case terms, as an array, -inf for assemblies that can't be completed at
+    # all, and which of them can. Terms are summed one by one, in order of pair id
+    # and then of leaf id.
+    completable = ~np.isneginf(terms).any(axis=1)
+    totals = np.cumsum(np.hstack((np.asarray(scores,dtype=float)[:,np.newaxis],terms)),
+                       axis=1)[:,-1]
+    totals[~completable] = -np.inf
+    return totals,completable
+  
+  def pairs_of_leaves(self,leaves):
+    # Sorted ids of all pairs involving any of the leaves
+    return np.unique(np.concatenate([self.pairs_of_leaf[leaf] for leaf in leaves]))
+  
+  def extended_bound_inputs(self,extension):
+    # Distances to root and score of the assembly extension would produce, the pairs
+    # whose best case terms change, which of those it accounts for, and the terms
+    # of free leaves that change. Distances of joins and attachments are also kept on
+    # them for building the assembly.
+    distances_to_root = self.distances_to_root.copy()
+    if hasattr(extension,'freq'):
+      distances_to_root[list(extension.leaves)] = 1
+      changed_pairs = self.pairs_of_leaves(extension.leaves)
+      return distances_to_root,self.score+extension.logfreq,changed_pairs,\
+             changed_pairs == extension.pair,self.free_leaf_term_ids(extension.leaves)
+    # Every leaf on either side of the new root moves one node further from it, and
+    # pairs of these leaves are all accounted for by the new clade
+    if hasattr(extension,'new_leaf'):
+      mask = extension.built_clade.mask | 1 << extension.new_leaf
+      changed_leaves = self.free_leaf_term_ids([extension.new_leaf])
+    else:
+      mask = extension.clades[0].mask | extension.clades[1].mask
+      changed_leaves = np.zeros(0,dtype=int)
+    leaves = mask_leaves(mask)
+    distances_to_root[leaves] += 1
+    extension.distances_to_root = distances_to_root
+    in_new_clade = np.zeros(len(self.leaf_names),dtype=bool)
+    in_new_clade[leaves] = True
+    changed_pairs = self.pairs_of_leaves(leaves)
+    changed_pair_leaves = self.pair_leaf_ids[changed_pairs]
+    return distances_to_root,self.score+extension.score,changed_pairs,\
+           in_new_clade[changed_pair_leaves[:,0]] & in_new_clade[changed_pair_leaves[:,1]],\
+           changed_leaves
+  
+  def bound_extensions(self,extensions):
+    # Scores and best cases of a batch of extensions as arrays, and which can be
+    # completed. Terms are copied from this assembly's, and only those of pairs each
+    # extension changes are recomputed, all at once. Joins and attachments keep their
+    # changed terms for building the assembly.
+    distances_to_root,scores,changed_pairs,accounted,changed_leaves =\
+                              zip(*(self.extended_bound_inputs(e) for e in extensions))
+    distances_to_root = np.array(distances_to_root)
+    pair_lengths = [len(p) for p in changed_pairs]
+    leaf_lengths = [len(l) for l in changed_leaves]
+    pair_rows = np.repeat(np.arange(len(extensions)),pair_lengths)
+    leaf_rows = np.repeat(np.arange(len(extensions)),leaf_lengths)
+    # The leaves of the clade each extension builds are those it moves away from
+    # the root
+    units = np.where(distances_to_root != self.distances_to_root,self.new_unit,
+                     self.leaf_units()) if self.triplet_bound else None
+    changed_pair_terms = self.best_case_terms_for(np.concatenate(changed_pairs),
+                                                  np.concatenate(accounted),
+                                                  distances_to_root,pair_rows,units)
+    changed_leaf_terms = self.free_leaf_terms_for(np.concatenate(changed_leaves),
+                                                  distances_to_root,leaf_rows)
+    terms = np.tile(self.best_case_terms,(len(extensions),1))
+    terms[pair_rows,np.concatenate(changed_pairs)] = changed_pair_terms
+    terms[leaf_rows,len(self.pair_leaves)+np.concatenate(changed_leaves)] =\
+                                                                      changed_leaf_terms
+    for extension,pairs,pair_terms,leaves,leaf_terms in itertools.izip(
+                            extensions,changed_pairs,
+                            np.split(changed_pair_terms,np.cumsum(pair_lengths)[:-1]),
+                            changed_leaves,
+                            np.split(changed_leaf_terms,np.cumsum(leaf_lengths)[:-1])):
+      if not hasattr(extension,'freq'):
+        extension.best_case_terms_delta = (self.best_case_terms,
+                                           np.concatenate((pairs,
+                                                           len(self.pair_leaves)+leaves)),
+                                           np.concatenate((pair_terms,leaf_terms)))
+    scores = np.array(scores)
+    return (scores,)+self.bounds(scores,terms)
   
   def best_case_with_extension(self,extension):
-    try:
-      updated_distances_to_root = {leaf:(self.distances_to_root[leaf]+1 if leaf in
-                                         self.distances_to_root else 1)
-                               for pair in itertools.chain(extension.consistent,
-                                                           extension.verified)
-                               for leaf in pair}
-      for leaf in self.distances_to_root:
-        if leaf not in updated_distances_to_root:
-          updated_distances_to_root[leaf] = self.distances_to_root[leaf]
-      
-      updated_pairs_accounted_for = {pair for pair in
-                                     itertools.chain(self.pairs_accounted_for,
-                                                     extension.verified)}
-      extension.distances_to_root = updated_distances_to_root
-      extension.pairs_accounted_for = updated_pairs_accounted_for
-    except AttributeError:
-      updated_distances_to_root = dict(self.distances_to_root.iteritems())
-      for leaf in extension.leaves:
-        updated_distances_to_root[leaf] = 1
-      updated_pairs_accounted_for = {pair for pair in self.pairs_accounted_for}
-      updated_pairs_accounted_for.add(extension.leaves)
-    
-    try:
-      best_possible_final_score = self.score + extension.score
-    except AttributeError:
-      best_possible_final_score = self.score + math.log(extension.freq)
-    return self.calculate_best_case(updated_pairs_accounted_for,
-                                    updated_distances_to_root,
-                                    best_possible_final_score)
+    return self.bound_extensions([extension])[1].item()
   
   def filter_proposed_extensions(self,new_pairs,joins,attachments,
-                                 encountered,min_score=None):
+                                 encountered,min_score=None,canonical=False):
     joins = self.verify_remaining_proposed_pairs(joins)
     attachments = self.verify_remaining_proposed_pairs(attachments)
+    # Extensions kept by the canonical rule (see find_extensions) produce assemblies
+    # no other extension does, so only complete topologies, which may have been
+    # accepted some other way, are looked up among encountered assemblies
+    look_up = not canonical or self.nodes_left_to_build == 1
     
-    for extension_set in (new_pairs,joins,attachments):
-      for key,extension in extension_set.items():
-        nested_repr = self.as_nested_sets(extension)
-        # First filter: has extension been encountered before?
+    # Scores and best cases of all remaining extensions are calculated, and checked
+    # against min_score, in one batch, so that nested set representations are only
+    # built, and looked up among encountered assemblies, for extensions that pass
+    extensions = [(extension_set,key,extension)
+                  for extension_set in (new_pairs,joins,attachments)
+                  for key,extension in extension_set.iteritems()]
+    if not extensions:
+      return new_pairs,joins,attachments
+    scores,best_cases,passing = self.bound_extensions([e for _,_,e in extensions])
+    if min_score is not None:
+      # Is score with extension already worse than min_score? Is there a way to extend
+      # the extension all the way to a full assembly, and is the upper limit on best
+      # score for that assembly already worse than min_score?
+      passing &= (scores >= min_score) & (best_cases >= min_score)
+    
+    # Best cases of extensions that pass are kept for build_extensions
+    self._extension_bounds = {}
+    for (extension_set,key,extension),passes,best_case in itertools.izip(extensions,
+                                                                         passing.tolist(),
+                                                                         best_cases.tolist()):
+      if not passes:
+        extension_set.pop(key)
+        continue
+      nested_repr = self.as_nested_sets(extension)
+      # Has extension been encountered before?
+      if look_up:
         if encountered.already_encountered(nested_repr):
           extension_set.pop(key)
           continue
-        # Second filter: is score with extension already worse than min_score?
-        if min_score is not None:
-          try: # Will fail if item is a new pair - forgiveness faster than permission
-            if extension.score + self.score < min_score:
-              extension_set.pop(key)
-              continue
-          except AttributeError: # Must be a new_pair:
-            if math.log(extension.freq) + self.score < min_score:
-              extension_set.pop(key)
-              continue
-        # Third filter: is there a way to extend the extension all the way to a full assembly?
-        # Is the upper limit on best score for that assembly already worse than min_score?
-        best_case = self.best_case_with_extension(extension)
-        if best_case is None or best_case < min_score:
-          extension_set.pop(key)
-          continue
         encountered.remember(nested_repr)
+      self._extension_bounds[key] = best_case
     
     return new_pairs,joins,attachments
   
-  def find_extensions(self,encountered,min_score=None):
-    new_pairs = {}
-    joins = self.KeyPassingDefaultDict(lambda key: ProposedExtension(*key))
-    attachments = self.KeyPassingDefaultDict(lambda key: ProposedExtension(*key))
-    already_connected = {frozenset(clade.leaf_names):i for i,clade in
-                                                       enumerate(self.built_clades)}
-    # All pairwise intersections should be empty
-    assert not any(frozenset.intersection(*leafsetpair)
-                   for leafsetpair in itertools.combinations(already_connected.iterkeys(),2))
-    already_connected_splat = frozenset({leaf for leafset in already_connected
-                                              for leaf in leafset})
-    ac_leafdict = {leaf:self.IndexedClade(i,self.built_clades[i])
-                   for leafset,i in already_connected.iteritems() for leaf in leafset}
-    for i in self.constraints_idx:
-      pair = self.constraints_master[i]
-      if pair.dist == 1:
-        # Pairs with distance 1 are added w/o questions. If continue with this path,
-        # later we will make sure to remove from consideration all pairs that conflict this.
-        new_pairs[i] = pair
-      elif not pair.leaves & already_connected_splat:
+  @property
+  def candidates(self):
+    # Joins and attachments proposed by live constraints, before verification of
+    # their remaining pairs, keyed by the masks of the clades (and the leaf) involved
+    return self._property_getter('_candidates')
+  
+  def tally_candidates(self,parent_candidates=None):
+    # An extension only drops constraints between leaves it brings together, and
+    # distance 1 constraints, so the live constraints between two built clades, or a
+    # built clade and a free leaf, stay the same until one of them is extended. Given
+    # the candidates of the assembly this one was extended from, those involving
+    # clades and leaves it still has are carried over, and only constraints of
+    # leaves in its newest clade are tallied.
+    constraints = self.constraints_master
+    if parent_candidates is None:
+      joins,attachments = {},{}
+      constraint_ids = np.flatnonzero(self.live_constraints & (constraints.dist > 1))
+    else:
+      clade_masks = set(self.clade_masks)
+      joins = {key:ext for key,ext in parent_candidates[0].iteritems()
+               if key <= clade_masks}
+      attachments = {key:ext for key,ext in parent_candidates[1].iteritems()
+                     if key[0] in clade_masks and key[1] in self.free_leaves}
+      constraint_ids = [ids for leaf in mask_leaves(self.clade_masks[-1])
+                        for dist,ids in constraints.by_leaf[leaf].iteritems() if dist > 1]
+      constraint_ids = np.concatenate(constraint_ids) if constraint_ids else\
+                                                        np.zeros(0,dtype=int)
+      # Sorted, so pairs are checked (and scores summed) in the same order as by a
+      # full tally
+      constraint_ids = np.unique(constraint_ids[self.live_constraints[constraint_ids]])
+    
+    distances_to_root = self.distances_to_root
+    # Leaf sets are bitmasks over leaf ids, so membership of pairs in built clades
+    # comes down to bitwise operations, and leaves are looked up in a list
+    connected_mask = 0
+    clade_of_leaf = [None]*len(self.leaf_names)
+    for i,mask in enumerate(self.clade_masks):
+      # All built clades should be disjoint
+      assert not connected_mask & mask
+      connected_mask |= mask
+      indexed_clade = self.IndexedClade(i,self.built_clades[i],mask)
+      for leaf in mask_leaves(mask):
+        clade_of_leaf[leaf] = indexed_clade
+    for i in constraint_ids.tolist():
+      pair = constraints[i]
+      connected = pair.mask & connected_mask
+      if not connected:
         # If a pair has distance > 1 and neither leaf in pair has already been added to a
         # clade, then we can't do anything with it, so we silently skip it
         continue
+      leaf1,leaf2 = self.pair_leaves[pair.pair]
+      if connected == pair.mask: # If both leaves are already in built clades
+        clade1,clade2 = clade_of_leaf[leaf1],clade_of_leaf[leaf2]
+        if clade1 is clade2:
+          # If one built clade already contains both leaves, there is nothing to do either
+          continue
+        else:
+          # If separate built clades contain one leaf each, then the pair goes into
+          # the corresponding join's ProposedExtension object
+          key = frozenset((clade1.mask,clade2.mask))
+          if key not in joins:
+            joins[key] = ProposedExtension(clade1,clade2,distances_to_root)
+          joins[key].check_pair(pair,i)
       else:
-        if pair.leaves <= already_connected_splat: # If both leaves are already in built clades
-          if any(pair.leaves <= built_leafset for built_leafset in already_connected.iterkeys()):
-            # If one built clade already contains both leaves, there is nothing to do either
-            continue
-          else:
-            # If separate built clades contain one leaf each, then the pair goes into
-            # the corresponding join's ProposedExtension object
-            joins[frozenset(ac_leafdict[leaf] for leaf in pair.leaves)].check_pair(pair,i)
+        # One leaf in pair is already contained in a built clade, the other isn't.
+        # Identify the new leaf and the built clade ...
+        if connected >> leaf1 & 1:
+          clade_of_attached_leaf,new_leaf = clade_of_leaf[leaf1],leaf2
         else:
-          # (pair.leaves & already_connected_splat) and (not pair.leaves <= already_connected_splat)
-          # implies one leaf in pair is already contained in a built clade, the other isn't
-          for leaf in pair.leaves: # Identify the new leaf and the built clade
-            try:
-              clade_of_attached_leaf = ac_leafdict[leaf]
-              attached_leaf = leaf
-            except KeyError as e:
-              new_leaf = leaf
-          # And put the pair into the corresponding attachment's ProposedExtension object
-          attachments[frozenset({clade_of_attached_leaf,new_leaf})].check_pair(pair,i)
-    return self.filter_proposed_extensions(new_pairs,joins,attachments,encountered,min_score)
+          clade_of_attached_leaf,new_leaf = clade_of_leaf[leaf2],leaf1
+        # And put the pair into the corresponding attachment's ProposedExtension object
+        key = (clade_of_attached_leaf.mask,new_leaf)
+        if key not in attachments:
+          attachments[key] = ProposedExtension(clade_of_attached_leaf,new_leaf,
+                                               distances_to_root)
+        attachments[key].check_pair(pair,i)
+    return joins,attachments
+  
+  def find_extensions(self,encountered,min_score=None,canonical=False):
+    # Pairs with distance 1 are added w/o questions. If continue with this path,
+    # later we will make sure to remove from consideration all pairs that conflict this.
+    constraints = self.constraints_master
+    new_pairs = {i:constraints[i] for i in
+                 np.flatnonzero(self.live_constraints & (constraints.dist == 1)).tolist()}
+    joins,attachments = self.candidates
+    if canonical:
+      # Whether a node can be built only depends on its children, so the same
+      # assembly is reached by building its clades' roots in any order. Only
+      # extensions whose new clade has the highest leaf id of all built leaves
+      # are kept, so that each assembly is reached from exactly one other: the one
+      # without the root of its clade with the highest leaf. Clades are disjoint,
+      # so that is the clade with the largest mask.
+      top = max(self.clade_masks) if self.clade_masks else 0
+      new_pairs = {i:pair for i,pair in new_pairs.iteritems() if pair.mask > top}
+      joins = {key:ext for key,ext in joins.iteritems() if top in key}
+      attachments = {key:ext for key,ext in attachments.iteritems()
+                     if key[0] == top or 1 << key[1] > top}
+    # Candidates are shared with assemblies extended from this one, so filtering
+    # works on copies of them
+    indexed_clades = {mask:self.IndexedClade(i,self.built_clades[i],mask)
+                      for i,mask in enumerate(self.clade_masks)}
+    joins = {key:ext.rebind(indexed_clades) for key,ext in joins.iteritems()}
+    attachments = {key:ext.rebind(indexed_clades) for key,ext in attachments.iteritems()}
+    return self.filter_proposed_extensions(new_pairs,joins,attachments,encountered,min_score,
+                                           canonical)
+    
+  def build_new_pair(self,pair,in_place=False):
+    build_in = self if in_place else self.copy()
+    constraints = self.constraints_master
+    # Drop all pairs with distance 1 and one member of pair - they can't have distance
+    # 1 with anyone except each other - and all pairs of these two leaves, including
+    # this one
+    for leaf in self.pair_leaves[pair.pair]:
+      build_in.drop_constraints(constraints.by_leaf[leaf].get(1,[]))
+    build_in.drop_constraints(constraints.by_pair[pair.pair])
     
-  def build_extensions(self,new_pairs,joins,attachments):
-    # Will need key of pair in new pairs, but not of keys in joins or attachments
-    all_ext_to_build = new_pairs.items()+joins.values()+attachments.values()
+    # Remove leaves in this pair from free_leaves
+    for leaf in pair.leaves:
+      build_in.free_leaves.remove(leaf) # Pop each leaf in pair from free_leaves
+    
+    # Build new clade and update the score
+    build_in.built_clades.append(CladeNode(*tuple(pair.leaves)))
+    build_in.recompute(extension=pair)
+    build_in.score += pair.logfreq
+    return build_in
+  
+  def build_extension(self,extension,in_place=False):
+    if hasattr(extension,'freq'):
+      return self.build_new_pair(extension,in_place)
+    return extension.build_extension(self,in_place)
+  
+  def build_extensions(self,new_pairs,joins,attachments,lazy=False):
+    all_ext_to_build = new_pairs.items()+joins.items()+attachments.items()
     extended_assemblies = []
+    parent_candidates = self.candidates
+    bounds = self._pop('_extension_bounds') or {}
+    if lazy and len(all_ext_to_build) > 1 and self.nodes_left_to_build > 1:
+      # Extensions that passed filtering are left as PendingAssembly descriptors of
+      # a snapshot of this assembly, since this one is extended in place last
+      snapshot = self.copy()
+      snapshot._candidates = parent_candidates
+    else:
+      lazy = False
     while all_ext_to_build:
-      extension = all_ext_to_build.pop()
-      try:
-        if not all_ext_to_build:
-          extended_assemblies.append(extension.build_extension(self,in_place=True))
-        else:
-          extended_assemblies.append(extension.build_extension(self))
-      except AttributeError:
-        if not all_ext_to_build:
-          build_in = self
-        else:
-          build_in = self.copy()
-        idx_of_pair,pair = extension # Now we can get the key (index of pair in constraints_idx)
-        
-        # Select for dropping all pairs with distance 1 and one member of pair - they can't
-        # have distance 1 with anyone except each other
-        drop_these = [i for i in self.constraints_idx if self.constraints_master[i].dist == 1 and
-                                              self.constraints_master[i].leaves & pair.leaves and
-                                            not self.constraints_master[i].leaves == pair.leaves]
-        # Select for dropping all pairs of these two leaves with distance > 1
-        drop_these.extend(i for i in self.constraints_idx if self.constraints_master[i].dist > 1
-                                            and self.constraints_master[i].leaves == pair.leaves)
-        drop_these.append(idx_of_pair) # Finally, select for dropping this pair
-        # Drop selected pairs from constraints_idx
-        build_in.constraints_idx = filter(lambda x: x not in drop_these,build_in.constraints_idx)
-        
-        # Remove leaves in this pair from free_leaves
-        for leaf in pair.leaves:
-          build_in.free_leaves.remove(leaf) # Pop each leaf in pair from free_leaves
-        
-        # Build new clade and update the score
-        build_in.built_clades.append(T.requisition(*tuple(pair.leaves)))
-        build_in.recompute(extension=pair)
-        build_in.score += math.log(pair.freq)
-        extended_assemblies.append(build_in)
+      key,extension = all_ext_to_build.pop()
+      if not all_ext_to_build:
+        extended_assemblies.append(self.build_extension(extension,in_place=True))
+      elif lazy and key in bounds:
+        extended_assemblies.append(PendingAssembly(snapshot,extension,bounds[key]))
+      else:
+        extended_assemblies.append(self.build_extension(extension))
     for a in extended_assemblies:
-      a.reset()
+      if isinstance(a,TreeAssembly):
+        a.reset()
+        a._pop('_candidates')
+        a._parent_candidates = parent_candidates
     return extended_assemblies
   
-  def generate_extensions(self,encountered_assemblies,min_score=None):
-    new_pairs,joins,attachments = self.find_extensions(encountered_assemblies,min_score)
+  def generate_extensions(self,encountered_assemblies,min_score=None,lazy=False,
+                          canonical=False):
+    new_pairs,joins,attachments = self.find_extensions(encountered_assemblies,min_score,
+                                                       canonical)
     if any((new_pairs,joins,attachments)):
-      return self.build_extensions(new_pairs, joins, attachments)
+      return self.build_extensions(new_pairs,joins,attachments,lazy)
     else:
       return None
 
 
+class PendingAssembly(object):
+  
+  # Descriptor of an assembly an extension would produce, standing in for it in the
+  # workspace until it is worked on (see TreeAssembly.build_extensions). Most
+  # extended assemblies are spilled to the FIFO without ever being worked on, and
+  # are compressed directly from their descriptors. Clade reprs and masks are those
+  # of the extended assembly, and parent is a snapshot of the assembly extended,
+  # shared by all descriptors extending it.
+  __slots__ = ('parent','extension','score','best_case','nodes_left_to_build',
+               'current_clades_as_nested_sets','clade_masks','sort_key')
+  
+  def __init__(self,parent,extension,best_case):
+    self.parent = parent
+    self.extension = extension
+    self.best_case = best_case
+    self.nodes_left_to_build = parent.nodes_left_to_build-1
+    if hasattr(extension,'freq'):
+      self.score = parent.score+extension.logfreq
+      self.current_clades_as_nested_sets = parent.current_clades_as_nested_sets+\
+                                            [frozenset({frozenset(extension.leaves),'r'})]
+      self.clade_masks = parent.clade_masks+[extension.mask]
+    else:
+      self.score = parent.score+extension.score
+      self.current_clades_as_nested_sets = extension.nested_set_reprs
+      self.clade_masks = extension.clade_masks
+    self.sort_key = parent.priority(self.score,best_case,self.nodes_left_to_build,
+                                    self.num_pairs_accounted_for)
+  
+  @property
+  def complete(self):
+    return self.nodes_left_to_build == 0
+  
+  @property
+  def built_nodes_count(self):
+    return self.parent.total_nodes_to_build-self.nodes_left_to_build
+  
+  num_pairs_accounted_for = TreeAssembly.num_pairs_accounted_for
+  
+  def compress(self):
+    encoded_clades = ''.join(self.parent.encode_clade(c)
+                             for nested_set in self.current_clades_as_nested_sets
+                             for c in nested_set if c != 'r')
+    return encoded_clades,self.score,self.best_case,self.nodes_left_to_build,self.sort_key
+  
+  def materialize(self):
+    assembly = self.parent.build_extension(self.extension)
+    assembly.reset()
+    assembly._sort_key = self.sort_key
+    assembly._parent_candidates = self.parent.candidates
+    return assembly
+
+
+def beam_search(zeroth_assembly,beam_width,num_topologies):
+  '''
+  Complete assemblies found quickly by extending, one node at a time, only the
+  beam_width assemblies with the highest best cases at each number of nodes
+  built. Returns the best num_topologies of them, best first. Assemblies are
+  tracked locally, so that no shared encountered assemblies are affected.
+  '''
+  encountered = SharedCladeReprTracker(zeroth_assembly.leaf_names,{})
+  beam = [zeroth_assembly.copy()]
+  # Complete assemblies are kept in a heap of (score, order found, assembly)
+  complete = []
+  order = itertools.count()
+  while beam:
+    # Once enough assemblies are complete, extensions that can't beat them are
+    # dropped while filtering
+    min_score = complete[0][0] if len(complete) == num_topologies else None
+    extended = [a for assembly in beam
+                for a in assembly.generate_extensions(encountered,min_score) or []]
+    for assembly in extended:
+      if assembly.complete:
+        if len(complete) < num_topologies:
+          heapq.heappush(complete,(assembly.score,next(order),assembly))
+        elif assembly.score > complete[0][0]:
+          heapq.heapreplace(complete,(assembly.score,next(order),assembly))
+    beam = heapq.nlargest(beam_width,(a for a in extended if not a.complete),
+                          key=lambda a: a.best_case)
+  return [assembly for _,_,assembly in sorted(complete,reverse=True)]
+
+
+
 #===============================================================================
 # Topology enumeration code
 #===============================================================================
@@ -599,9 +1199,11 @@ class CladeReprTracker(object):
   
   def _recursively_build_repr(self,c):
     nonleaflist = sorted((self._recursively_build_repr(m) for m in c if not
-                          isinstance(m,str)),key=lambda x: x[1])
+                          isinstance(m,int)),key=lambda x: x[1])
     nonleaves = ','.join(v[0] for v in nonleaflist)
-    leafnumbers = sorted(self.leaves[m] for m in c if isinstance(m,str))
+    # Leaves are interned as ids following the sorted order of leaf names, so
+    # their numbers in the repr (see self.leaves) are simply id+1
+    leafnumbers = sorted(m+1 for m in c if isinstance(m,int))
     leaves = ','.join(str(leaf) for leaf in leafnumbers)
     returnstr = '('
     take_my_min = []
@@ -632,6 +1234,8 @@ class CladeReprTracker(object):
 
 class SharedCladeReprTracker(CladeReprTracker):
   def __init__(self,leaves,shared_dict):
+    # Reprs are kept in a dict, or, when shared by processes, in a
+    # SharedFingerprintSet standing in for one
     self.encountered = shared_dict
     self.leaves = {leaf:i+1 for i,leaf in enumerate(sorted(leaves))}
   
@@ -656,13 +1260,16 @@ class AssemblyWorkspace(object):
   def __init__(self,seed_assembly,num_requested_trees,max_workspace_size,
                     encountered_assemblies_storage,fifo=None,
                     track_min_score=True,acceptance_ratio_param=2.0,
-                    acceptance_stiffness_param=1.0):
+                    acceptance_stiffness_param=1.0,canonical_extensions=True):
     if isinstance(seed_assembly,list):
       seed_assembly = TreeAssembly(*seed_assembly)
     self.workspace = [seed_assembly]
     self.accepted_assemblies = []
     self.rejected_assemblies = []
     self.encountered_assemblies = encountered_assemblies_storage
+    # With canonical extensions, each assembly is reached only once, and only
+    # complete ones are remembered as encountered, so none need to be forgotten
+    self.canonical_extensions = canonical_extensions
     
     self.num_requested_trees = num_requested_trees
     self._reached_num_requested_trees = False
@@ -722,8 +1329,9 @@ class AssemblyWorkspace(object):
         rejected_assemblies.append(popped)
     else:
       uncompressed_assembly = TreeAssembly.uncompress(popped)
-      self.encountered_assemblies.forget(
-                           uncompressed_assembly.current_clades_as_nested_sets)
+      if not self.canonical_extensions:
+        self.encountered_assemblies.forget(
+                             uncompressed_assembly.current_clades_as_nested_sets)
       self.log("TopoffRejected",uncompressed_assembly)
 
   
@@ -855,9 +1463,13 @@ class AssemblyWorkspace(object):
         drop_from_workspace_idx.append(i)
         continue
       else:
+        # Assemblies are only built from their descriptors once worked on
+        assembly = self.workspace[i] = assembly.materialize()
         extended_assemblies = assembly.generate_extensions(
                                                    self.encountered_assemblies,
-                                                           self.curr_min_score)
+                                                           self.curr_min_score,
+                                                           lazy=True,
+                                          canonical=self.canonical_extensions)
         if extended_assemblies is None:
           self.log("AbandonedNoExtensions",assembly)
           drop_from_workspace_idx.append(i)
@@ -870,7 +1482,7 @@ class AssemblyWorkspace(object):
                                if self.check_completion_status(asbly)
                                                                   is not None])
     for i in drop_from_workspace_idx[::-1]:
-      if self.workspace[i] in self.accepted_assemblies:
+      if self.workspace[i] in self.accepted_assemblies or self.canonical_extensions:
         # Don't want to forget an accepted assembly because that can result in
         # accepting the same assembly twice!
         self.workspace.pop(i)
@@ -888,12 +1500,12 @@ class WorkerProcAssemblyWorkspace(AssemblyWorkspace):
   class AssemblyWorkFinished(Exception):
     pass
   
-  def __init__(self,fifo,queue,min_score,shared_encountered_assemblies_dict,
+  def __init__(self,fifo,queue,min_score,shared_encountered_assemblies,
                score_submission_queue,start_time_val,leaves_to_assemble,seed_assembly,
                num_requested_trees,max_workspace_size,monitor_activity=False,
                max_monitor_file_size=100*1024**2,**kwargs):
     encountered_assemblies = SharedCladeReprTracker(leaves_to_assemble,
-                                            shared_encountered_assemblies_dict)
+                                            shared_encountered_assemblies)
     AssemblyWorkspace.__init__(self,seed_assembly,num_requested_trees,
                                     max_workspace_size,encountered_assemblies,
                                     fifo,track_min_score=False,**kwargs)
@@ -1020,7 +1632,7 @@ class WorkerProcAssemblyWorkspace(AssemblyWorkspace):
         self.score_submission_queue.put(assembly.score)
         self.accepted_assemblies.append(assembly)
         if self._monitor_activity:
-          self.complete_trees_fh.write(str(assembly.score)+'\t'+assembly.built_clades[0].write('as_string','newick',plain=True))
+          self.complete_trees_fh.write(str(assembly.score)+'\t'+assembly.as_newick())
       else:
         self.log("CompleteRejected",assembly)
         self.rejected_assemblies.append(assembly)
@@ -1108,6 +1720,7 @@ class RestartQueueReloader(multiprocessing.Process):
     self.release_loaders = release_loaders
     self.initial_batch_size = initial_batch_size
     self.dummy_assembly = dummy_assembly
+    # Saved topologies number leaves from 1, assemblies use leaf ids from 0
     self.leaf_name_map = {i+1:leaf for i,leaf in enumerate(sorted(
                                                 dummy_assembly.leaves_master))}
     self.numproc = numproc
@@ -1120,15 +1733,12 @@ class RestartQueueReloader(multiprocessing.Process):
   @staticmethod
   def prepare_assembly_state(stored_string,leaf_name_map,dummy_assembly):
     built_clades,score,best_case,left_to_build = eval(stored_string)
-    built_clades = [T_BASE(StringIO(c)) for c in built_clades]
+    built_clades = [T_BASE(StringIO(c)).wrapped.root for c in built_clades]
     for c in built_clades:
       for l in c.get_terminals():
-        l.name = leaf_name_map[eval(l.name)]
-    built_repr = ';'.join(''.join(repr(dummy_assembly.convert_containers(
-                                                 c.nested_set_repr())).split())
-             for c in built_clades)
-    for k,v in dummy_assembly.pickle_encoding.items():
-      built_repr = built_repr.replace(v,k)
+        l.name = leaf_name_map[int(l.name)]
+    built_repr = ''.join(dummy_assembly.encode_clade(T._nsrepr(c))
+                         for c in built_clades)
     return built_repr,score,best_case,left_to_build
   
   def run(self):
@@ -1193,7 +1803,7 @@ class AssemblerProcess(multiprocessing.Process):
     cls.instcount += 1
     return multiprocessing.Process.__new__(cls,*args,**kwargs)
   
-  def __init__(self,queue,shared_encountered_assemblies_dict,shared_min_score,
+  def __init__(self,queue,shared_encountered_assemblies,shared_min_score,
                     score_submission_queue,seed_assembly,pass_to_workspace,
                     start_time_val,results_queue,release_queue_loader,
                     fifo_max_file_size=1.0):
@@ -1202,7 +1812,7 @@ class AssemblerProcess(multiprocessing.Process):
     
     self.queue = queue
     self.min_score = shared_min_score
-    self.encountered_assemblies_dict = shared_encountered_assemblies_dict
+    self.encountered_assemblies_set = shared_encountered_assemblies
     self.score_submission_queue = score_submission_queue
     self.pass_to_workspace = pass_to_workspace
     self.seed_assembly = seed_assembly
@@ -1221,10 +1831,7 @@ class AssemblerProcess(multiprocessing.Process):
   
   def enqueue_results(self):
     for assembly in self.assemblies.accepted_assemblies:
-      accepted = AcceptedAssembly(assembly.score,
-                                  assembly.built_clades[0].write('as_string',
-                                                               format='newick',
-                                                                 plain=True))
+      accepted = AcceptedAssembly(assembly.score,assembly.as_newick())
       self.results_queue.put(accepted)
     self.results_queue.put('FINISHED')
   
@@ -1233,7 +1840,7 @@ class AssemblerProcess(multiprocessing.Process):
                                     max_file_size_GB=self.fifo_max_file_size)
     self.pass_to_workspace.kwargs['seed_assembly'] = self.seed_assembly
     self.assemblies = WorkerProcAssemblyWorkspace(self.fifo,self.queue,self.min_score,
-                                                  self.encountered_assemblies_dict,
+                                                  self.encountered_assemblies_set,
                                                   self.score_submission_queue,
                                                   self.start_time,
                                                   *self.pass_to_workspace.args,
@@ -1283,14 +1890,13 @@ class AssemblerProcess(multiprocessing.Process):
 
 def unpickle_assembly_for_save(pickled_assembly_state):
   state = globals()['zeroth_assembly']._unpack_state(pickled_assembly_state)
-  state['built_clades'] = [T.rebuild_on_unpickle(c).write('as_string',
-                                                           format='newick',
-                                                           plain=True)
+  # Leaves are saved under their CladeReprTracker numbers, i.e. leaf id + 1
+  state['built_clades'] = [T.rebuild_on_unpickle(c).write_renamed(
+                                                         lambda leaf: leaf+1,
+                                                         'as_string',
+                                                         format='newick',
+                                                         plain=True)
                            for c in state['built_clades']]
-  for i,c in enumerate(state['built_clades']):
-    for k,v in globals()['leaf_name_encoding']:
-      c = c.replace(k,str(v))
-    state['built_clades'][i] = c
   return state
 
 
@@ -1300,12 +1906,24 @@ class MainTopologyEnumerationProcess(multiprocessing.Process):
                     max_queue_size=10000,fifo_max_file_size=1.0,
                     num_requested_topologies=1000,num_workers=None,
                     save_file_name='early_termination_save',
-                    restart_from=None,**kwargs):
+                    restart_from=None,triplet_bound=False,
+                    warm_start_beam_width=100,encountered_table_size=2**22,**kwargs):
     multiprocessing.Process.__init__(self)
+    # Histograms may also be passed as the path to a text or compiled histogram
+    # file, in which case a compiled file is memory-mapped rather than parsed
+    if isinstance(leafdist_histograms,basestring):
+      leafdist_histograms = load_pwhist(leafdist_histograms)
+    # Fail on configurations that can't produce any topology before any
+    # processes are started
+    self.preflight_report = preflight.check(leafdist_histograms,
+                                            constraint_freq_cutoff,
+                                            absolute_freq_cutoff)
+    
     self.assembly_queue_manager = multiprocessing.Manager()
     self.assembly_queue = self.assembly_queue_manager.Queue(max_queue_size)
-    self.encountered_assemblies_manager = multiprocessing.Manager()
-    self.encountered_assemblies_dict = self.encountered_assemblies_manager.dict()
+    # Encountered assemblies are remembered in shared memory, directly accessible
+    # to all processes forked from this one (see fingerprints.py)
+    self.encountered_assemblies_set = SharedFingerprintSet(encountered_table_size)
     self.results_queue = multiprocessing.Queue()
     self.scores_queue = multiprocessing.Queue()
     self.min_score = multiprocessing.Value('d',-sys.float_info.max)
@@ -1331,23 +1949,31 @@ class MainTopologyEnumerationProcess(multiprocessing.Process):
     self.zeroth_assembly = TreeAssembly(self.histograms,
                                         self.constraint_freq_cutoff,
                                         self.leaves,self.absolute_freq_cutoff,
-                                        keep_alive_when_pickling=False)
+                                        triplet_bound=triplet_bound)
     self.save_file_name = save_file_name
     self.restart_from = restart_from
     if restart_from is not None:
       self.initial_batch_size = max(int(round(max_queue_size*0.1)),1000)
       self.expected_number_results_queue_sentinels += 1
+      # Assemblies saved by a run without canonical extensions may be reached
+      # again from each other, so restarted runs look all of them up
+      kwargs.setdefault('canonical_extensions',False)
+    # Fresh runs start from topologies found by a beam search of this width, or
+    # from none if it is 0 (see warm_start)
+    self.warm_start_beam_width = warm_start_beam_width if restart_from is None else 0
+    if self.warm_start_beam_width:
+      self.expected_number_results_queue_sentinels += 1
     self.kwargs = kwargs
   
   def clean_up(self):
     self.assembly_queue_manager.shutdown()
-    self.encountered_assemblies_manager.shutdown()
     self.results_queue.close()
     self.results_queue.join_thread()
     self.scores_queue.close()
     self.scores_queue.join_thread()
     self.send_PIDs.close()
     self.get_PIDs.close()
+    self.encountered_assemblies_set.close()
   
   def assemblies_from_queue_generator(self):
     emptied_FIFO_counter = 0
@@ -1362,9 +1988,8 @@ class MainTopologyEnumerationProcess(multiprocessing.Process):
         continue 
   
   @staticmethod
-  def pool_assembly_unpickler_worker_init(zeroth_assembly,leaf_name_encoding):
+  def pool_assembly_unpickler_worker_init(zeroth_assembly):
     globals()['zeroth_assembly'] = zeroth_assembly
-    globals()['leaf_name_encoding'] = leaf_name_encoding.items() 
   
   def write_save(self):
     leaf_name_encoding = CladeReprTracker(self.leaves).leaves
@@ -1374,8 +1999,7 @@ class MainTopologyEnumerationProcess(multiprocessing.Process):
       wh.write(repr(reverse_encoding)+'\n')
     worker_pool = multiprocessing.Pool(self.num_workers,
                           initializer=self.pool_assembly_unpickler_worker_init,
-                                       initargs=(self.zeroth_assembly,
-                                                 leaf_name_encoding))
+                                       initargs=(self.zeroth_assembly,))
     assembly_states = worker_pool.imap(unpickle_assembly_for_save,
                                        self.assemblies_from_queue_generator())
     worker_pool.close()
@@ -1386,12 +2010,8 @@ class MainTopologyEnumerationProcess(multiprocessing.Process):
                        state['_nodes_left_to_build'])).replace(' ','')+'\n')
     worker_pool.join()
     with open('tmp_savedir/encountered_assemblies','w',0) as wh:
-      while True:
-        try:
-          assembly_repr,_ = self.encountered_assemblies_dict.popitem()
-          wh.write(assembly_repr+'\n')
-        except KeyError:
-          break
+      for fp in self.encountered_assemblies_set.fingerprints():
+        wh.write('%016x\n' % fp)
     
     accepted = []
     finished_worker_counter = 0
@@ -1409,17 +2029,36 @@ class MainTopologyEnumerationProcess(multiprocessing.Process):
     shutil.make_archive(self.save_file_name,'gztar','tmp_savedir')
     shutil.rmtree('tmp_savedir')
   
+  def warm_start(self):
+    # Topologies found by a beam search are accepted before workers start, like
+    # those of a restarted run, so that min_score prunes from the first iteration.
+    # They are remembered as encountered, so enumeration doesn't accept them
+    # again, and results are still exact, since min_score only rises once the
+    # requested number of topologies has been accepted.
+    encountered = SharedCladeReprTracker(self.leaves,self.encountered_assemblies_set)
+    for assembly in beam_search(self.zeroth_assembly,self.warm_start_beam_width,
+                                self.num_requested_topologies):
+      encountered.remember(assembly.current_clades_as_nested_sets)
+      self.results_queue.put(AcceptedAssembly(assembly.score,assembly.as_newick()))
+      self.accepted_scores.append(assembly.score)
+    self.results_queue.put('FINISHED')
+    if len(self.accepted_scores) == self.num_requested_topologies:
+      self.min_score.value = self.accepted_scores[-1]
+  
   def set_up_initial_run(self,workspace_args):
+    self.accepted_scores = []
+    if self.warm_start_beam_width:
+      self.warm_start()
     self.release_queue_loaders.set()
     seed_assemblies = [self.zeroth_assembly]
     while len(seed_assemblies) < self.num_workers:
       seed_assemblies = [a for old_a in seed_assemblies
                          for a in old_a.generate_extensions(
                                   SharedCladeReprTracker(self.leaves,
-                                            self.encountered_assemblies_dict))]
+                                            self.encountered_assemblies_set))]
     seed_assemblies.sort(key=lambda a: a.sort_key)
     procs = [AssemblerProcess(self.assembly_queue,
-                              self.encountered_assemblies_dict,
+                              self.encountered_assemblies_set,
                               self.min_score,self.scores_queue,
                               seed_assemblies.pop(),workspace_args,
                               self.start_time,self.results_queue,
@@ -1428,7 +2067,6 @@ class MainTopologyEnumerationProcess(multiprocessing.Process):
              for i in xrange(self.num_workers)]
     while seed_assemblies:
       self.assembly_queue.put(seed_assemblies.pop().compress())
-    self.accepted_scores = []
     return procs
   
   def set_up_restarted_run(self,workspace_args):
@@ -1463,12 +2101,17 @@ class MainTopologyEnumerationProcess(multiprocessing.Process):
       assert eval(fh.read()) == reverse_leaf_map
       fh.close()
       fh = tf.extractfile('./encountered_assemblies')
+      # Saves hold fingerprints of encountered assemblies, or, if written before
+      # fingerprints were kept, their reprs
       for l in fh:
-        self.encountered_assemblies_dict[l.strip()] = None
+        if l.startswith('['):
+          self.encountered_assemblies_set[l.strip()] = None
+        else:
+          self.encountered_assemblies_set.add_fingerprint(int(l,16))
       fh.close()
     self.restart_queue_loader.start_workers.wait()
     procs = [AssemblerProcess(self.assembly_queue,
-                              self.encountered_assemblies_dict,
+                              self.encountered_assemblies_set,
                               self.min_score,self.scores_queue,
                               TreeAssembly.uncompress(self.assembly_queue.get()),
                               workspace_args,
@@ -8,6 +8,12 @@ from StringIO import StringIO
 from Bio import Phylo
 from Bio.Phylo.BaseTree import Clade
 
+
+def is_leaf_name(obj):
+  # Leaves may be named by strings or by integer ids
+  return isinstance(obj,(basestring,int,long))
+
+
 class T_BASE(object):
   
   def __new__(cls,*args,**kwargs):
@@ -67,7 +73,8 @@ class T_BASE(object):
                 else self.recursively_split(pset) if len(pset) > 1 else pset.pop() for pset in paths]
   
   def _fix_symbols_in_names(self):
-    if any([True if l.name.find(':') > -1 or l.name.find('.') > -1 else False
+    if any([True if isinstance(l.name,basestring) and
+                    (l.name.find(':') > -1 or l.name.find('.') > -1) else False
             for l in self._wrapped_obj.get_terminals()]):
       self._orig_leaf_names = [l.name for l in self._wrapped_obj.get_terminals()]
       for l in self._wrapped_obj.get_terminals():
@@ -278,8 +285,12 @@ class T_BASE(object):
       path_root = self._hostObj
     else:
       path_root = self.wrapped
-    if not target and not kwargs:
+    if target is None and not kwargs:
       return [self._get_spawned(n) for n in self._hostObj.get_path(self.wrapped)]
+    elif isinstance(target,(int,long)):
+      # Bio.Phylo only matches names given as strings
+      return [self._get_spawned(n) for n in
+                                path_root.get_path(lambda n: n.name == target)]
     elif hasattr(target,'wrapped'):
       return [self._get_spawned(n) for n in path_root.get_path(target.wrapped,**kwargs)]
     else:
@@ -322,6 +333,24 @@ class T_BASE(object):
       return strhandle.getvalue()
     else:
       Phylo.write(self.wrapped,filepath,format,**kwargs)
+  
+  def write_renamed(self,rename,filepath,format=None,**kwargs):
+    '''
+    Write a copy of the tree in which each leaf is named rename(leaf.name),
+    leaving this tree untouched. Used to write trees whose leaves are named by
+    integer ids under their actual names.
+    '''
+    if not format:
+      format = self.format
+    renamed = copy.deepcopy(self.wrapped)
+    for leaf in renamed.get_terminals():
+      leaf.name = str(rename(leaf.name))
+    if filepath == 'as_string':
+      strhandle = StringIO()
+      Phylo.write(renamed,strhandle,format,**kwargs)
+      return strhandle.getvalue()
+    else:
+      Phylo.write(renamed,filepath,format,**kwargs)
 
 
 
@@ -392,7 +421,7 @@ class T(T_BASE):
   def requisition(cls,clade_def1,clade_def2,*args):
     new_clades_attr = []
     for c in (clade_def1,clade_def2)+args:
-      if isinstance(c,str):
+      if is_leaf_name(c):
         if c in cls._to_wrapped_map:
           new_clades_attr.append(cls._to_wrapped_map[c])
         else:
@@ -421,7 +450,7 @@ class T(T_BASE):
         return cls(cls._to_wrapped_map[clade_repr])
       else:
         return cls._to_wrapped_map[clade_repr]
-    elif isinstance(clade_repr,str):
+    elif is_leaf_name(clade_repr):
       leaf = Clade(name=clade_repr)
       cls._to_wrapped_map[clade_repr] = leaf
       return leaf
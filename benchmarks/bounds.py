@@ -0,0 +1,70 @@
+# Author: Roman Sloutsky <sloutsky@wustl.edu>
+
+#===============================================================================
+# Assemblies pruned by the triplet bound
+#===============================================================================
+
+# Enumerates the best topologies of each example by branch-and-bound in a single
+# process, best case first, with and without the triplet bound (see
+# aspen/bounds.py), and counts the assemblies extended and those generated. Both
+# runs should find the same scores; the triplet bound can only cut the counts.
+#
+# Usage: python benchmarks/bounds.py [<number of topologies> [<histograms file> ...]]
+
+import os
+import sys
+import glob
+import heapq
+import time
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),os.pardir))
+from aspen import topolenum
+from aspen.pwhist import load_pwhist
+
+
+def enumerate_best(histograms,num_topologies,triplet_bound):
+  leaves = {leaf for pair,_ in histograms for leaf in pair}
+  zeroth = topolenum.TreeAssembly(histograms,0.99,leaves,0.001,
+                                  triplet_bound=triplet_bound)
+  encountered = topolenum.SharedCladeReprTracker(leaves,{})
+  scores = []
+  heap = [(-zeroth.best_case,0,zeroth)]
+  counter = 1
+  extended = 0
+  while heap:
+    best_case,_,assembly = heapq.heappop(heap)
+    min_score = scores[0] if len(scores) == num_topologies else None
+    if min_score is not None and -best_case < min_score:
+      break
+    extended += 1
+    for a in assembly.generate_extensions(encountered,min_score) or []:
+      counter += 1
+      if a.complete:
+        if len(scores) < num_topologies:
+          heapq.heappush(scores,a.score)
+        elif a.score > scores[0]:
+          heapq.heapreplace(scores,a.score)
+      else:
+        heapq.heappush(heap,(-a.best_case,counter,a))
+  return sorted(scores,reverse=True),extended,counter-1,len(zeroth.triplet_leaves)
+
+
+if __name__ == '__main__':
+  num_topologies = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+  histograms_files = sys.argv[2:] or\
+                     sorted(glob.glob(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                   os.pardir,'examples','*.txt')))
+  for histograms_file in histograms_files:
+    histograms = load_pwhist(histograms_file)
+    results = []
+    for triplet_bound in (False,True):
+      start = time.time()
+      results.append(enumerate_best(histograms,num_topologies,triplet_bound)+
+                     (time.time()-start,))
+    (scores,extended,generated,_,elapsed),(t_scores,t_extended,t_generated,
+                                           triplets,t_elapsed) = results
+    assert [round(s,8) for s in scores] == [round(s,8) for s in t_scores]
+    print "%s: %d packed triplets" % (os.path.basename(histograms_file),triplets)
+    print "  pair bound     %8d extended  %8d generated  %6.1f s" % (extended,generated,
+                                                                     elapsed)
+    print "  triplet bound  %8d extended  %8d generated  %6.1f s  (%d fewer generated)"\
+          % (t_extended,t_generated,t_elapsed,generated-t_generated)
@@ -0,0 +1,148 @@
+# Author: Roman Sloutsky <sloutsky@wustl.edu>
+
+#===============================================================================
+# Per-object memory footprint of assemblies and proposed extensions
+#===============================================================================
+
+# Expands assemblies of one of the examples best case first, with the current
+# code and with the code of a baseline revision, which is extracted with git
+# archive and imported as aspen_baseline, and measures with sys.getsizeof the
+# TreeAssembly and ProposedExtension instances each produces. An object is
+# measured with the objects, containers and arrays held by its attributes, down
+# to those the containers hold, each counted once along with its instance dict,
+# if it has one, since slots hold what the dict would.
+# Arrays and candidate tables an assembly shares with others, such as its live
+# constraint mask and its best case terms, are counted in full for every
+# assembly that holds them, and also once for all objects collected, which is
+# what holding all of them at once takes. Leaf names, ids and other atoms are
+# not counted.
+#
+# Usage: python benchmarks/memory.py [<histograms file> [<number of expansions>
+#                                     [<baseline revision>]]]
+#
+# The baseline revision defaults to the first commit of the repository.
+
+import os
+import sys
+import heapq
+import atexit
+import shutil
+import tarfile
+import tempfile
+import importlib
+import subprocess
+from cStringIO import StringIO
+import numpy as np
+REPOSITORY = os.path.join(os.path.dirname(os.path.abspath(__file__)),os.pardir)
+sys.path.insert(0,REPOSITORY)
+from aspen import topolenum
+from aspen.pwhist import load_pwhist
+
+ATOMS = (int,long,float,bool,basestring,type(None))
+CONTAINERS = (list,tuple,set,frozenset)
+
+
+def load_baseline(revision):
+  # topolenum as of revision, from a copy of the aspen package renamed so that it
+  # can be imported alongside the current one
+  directory = tempfile.mkdtemp(prefix='aspen_baseline_')
+  atexit.register(shutil.rmtree,directory,True)
+  archive = subprocess.check_output(['git','archive',revision,'aspen'],cwd=REPOSITORY)
+  tarfile.open(fileobj=StringIO(archive)).extractall(directory)
+  os.rename(os.path.join(directory,'aspen'),os.path.join(directory,'aspen_baseline'))
+  sys.path.insert(0,directory)
+  return importlib.import_module('aspen_baseline.topolenum')
+
+
+def attributes(obj):
+  names = set(getattr(obj,'__dict__',()))
+  for cls in type(obj).__mro__:
+    names.update(getattr(cls,'__slots__',()))
+  return [getattr(obj,name) for name in names if hasattr(obj,name)]
+
+
+def footprint(obj,levels=2,seen=None):
+  # Objects in seen are not counted again
+  seen = set() if seen is None else seen
+  def size(o,level):
+    if isinstance(o,ATOMS) or id(o) in seen:
+      return 0
+    seen.add(id(o))
+    total = sys.getsizeof(o)
+    # The instance dict of an object is part of it, as slots are
+    instance_dict = getattr(o,'__dict__',None)
+    if isinstance(instance_dict,dict) and id(instance_dict) not in seen:
+      seen.add(id(instance_dict))
+      total += sys.getsizeof(instance_dict)
+    if isinstance(o,np.ndarray) and not o.flags.owndata:
+      total += o.nbytes
+    if level and isinstance(o,CONTAINERS):
+      total += sum(size(item,level-1) for item in o)
+    elif level and isinstance(o,dict):
+      total += sum(size(k,level-1)+size(v,level-1) for k,v in o.iteritems())
+    return total
+  total = size(obj,0)
+  return total+sum(size(value,levels) for value in attributes(obj))
+
+
+def collect(module,histograms,expansions):
+  leaves = {leaf for pair,_ in histograms for leaf in pair}
+  zeroth = module.TreeAssembly(histograms,0.99,leaves,0.001)
+  encountered = module.SharedCladeReprTracker(leaves,{})
+  assemblies,extensions = [],[]
+  heap = [(-zeroth.best_case,0,zeroth)]
+  counter = 1
+  while heap and expansions:
+    assembly = heapq.heappop(heap)[2]
+    if assembly.complete:
+      continue
+    new_pairs,joins,attachments = assembly.find_extensions(encountered,-sys.float_info.max)
+    extensions.extend(joins.values()+attachments.values())
+    for extended in assembly.build_extensions(new_pairs,joins,attachments):
+      assemblies.append(extended)
+      # The baseline has no best case for assemblies that can't be completed
+      if extended.best_case is not None:
+        heapq.heappush(heap,(-extended.best_case,counter,extended))
+      counter += 1
+    expansions -= 1
+  return assemblies,extensions
+
+
+def footprints_together(objects):
+  # Footprints of objects measured one after another, so that what they share is
+  # only counted for the first
+  seen = set()
+  return [footprint(o,seen=seen) for o in objects]
+
+
+def report(name,baseline_objects,objects):
+  if not objects or not baseline_objects:
+    print "%s: none collected" % name
+    return
+  print name
+  for label,measure in (('each on its own',lambda objs: map(footprint,objs)),
+                        ('all together',footprints_together)):
+    before = sum(measure(baseline_objects))/float(len(baseline_objects))
+    after = sum(measure(objects))/float(len(objects))
+    print "  %-16s baseline %8.0f bytes  current %8.0f bytes  (%+0.0f%%)"\
+          % (label,before,after,100*(after/before-1))
+
+
+if __name__ == '__main__':
+  histograms_file = sys.argv[1] if len(sys.argv) > 1 else\
+                    os.path.join(REPOSITORY,'examples','pw_path_length_histograms1.txt')
+  expansions = int(sys.argv[2]) if len(sys.argv) > 2 else 500
+  revision = sys.argv[3] if len(sys.argv) > 3 else\
+             subprocess.check_output(['git','rev-list','--max-parents=0','HEAD'],
+                                     cwd=REPOSITORY).split()[-1]
+  histograms = list(load_pwhist(histograms_file))
+  baseline_assemblies,baseline_extensions = collect(load_baseline(revision),histograms,
+                                                    expansions)
+  assemblies,extensions = collect(topolenum,histograms,expansions)
+  print "Bytes per object after %d expansions of %s; baseline revision %s, %d "\
+        "assemblies and %d proposed extensions; current, %d and %d"\
+        % (expansions,os.path.basename(histograms_file),revision[:10],
+           len(baseline_assemblies),len(baseline_extensions),len(assemblies),
+           len(extensions))
+  report('TreeAssembly',baseline_assemblies,assemblies)
+  report('ProposedExtension',baseline_extensions,extensions)
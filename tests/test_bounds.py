@@ -0,0 +1,86 @@
+# Author: Roman Sloutsky <sloutsky@wustl.edu>
+
+import unittest
+import math
+import itertools
+import numpy as np
+from aspen import bounds
+from aspen.constraints import pair_id
+
+
+class TestTripletBounds(unittest.TestCase):
+
+  def pair_log_freqs(self,num_leaves,histogram):
+    # The same histogram for every pair of leaves
+    table = np.empty((num_leaves*(num_leaves-1)//2,num_leaves))
+    table.fill(-np.inf)
+    for dist,freq in histogram:
+      table[:,dist] = math.log(freq)
+    return table
+
+  def test_consistent_triplet_distances(self):
+    # d(x,y),d(x,z),d(y,z) of ((x,y),z), (((x,u),y),z) and ((x,y),(z,w))
+    for distances in [(1,2,2),(2,3,2),(1,3,3)]:
+      for d in itertools.permutations(distances):
+        self.assertTrue(bounds.consistent_triplet_distances(*d))
+    for distances in [(2,2,2),(1,1,3),(1,2,4),(1,3,2)]:
+      self.assertFalse(bounds.consistent_triplet_distances(*distances))
+    self.assertEqual(bounds.consistent_triplet_distances(np.array([1,2]),np.array([2,2]),
+                                                         np.array([2,2])).tolist(),
+                     [True,False])
+
+  def test_triplet_gains(self):
+    # Three leaves can't all be at distance 2, so one pair of each triplet is at 3
+    triplets,gains = bounds.triplet_gains(self.pair_log_freqs(5,[(2,0.6),(3,0.4)]),5)
+    self.assertEqual(triplets.tolist(),[list(t) for t in itertools.combinations(range(5),3)])
+    self.assertTrue(np.allclose(gains,math.log(0.6)-math.log(0.4)))
+    # and if they can only be at distance 2, no tree has them
+    triplets,gains = bounds.triplet_gains(self.pair_log_freqs(4,[(2,1.0)]),4)
+    self.assertTrue(np.isposinf(gains).all())
+    # but any two of them can be at distance 1 from the third
+    triplets,gains = bounds.triplet_gains(self.pair_log_freqs(4,[(1,0.5),(2,0.5)]),4)
+    self.assertFalse(gains.any())
+    # and triplets whose best distances are consistent aren't returned at all
+    triplets,gains = bounds.triplet_gains(self.pair_log_freqs(4,[(1,0.3),(3,0.7)]),4)
+    self.assertEqual((triplets.shape,gains.shape),((0,3),(0,)))
+  
+  def test_triplet_gains_in_chunks(self):
+    rng = np.random.RandomState(0)
+    table = np.log(rng.rand(21,7))
+    table[rng.rand(21,7) < 0.6] = -np.inf
+    triplets,gains = bounds.triplet_gains(table,7,chunk_size=3)
+    expected = []
+    for x,y,z in itertools.combinations(range(7),3):
+      pairs = [pair_id(x,y),pair_id(x,z),pair_id(y,z)]
+      if not np.isneginf(table[pairs].max(axis=1)).any() and\
+         not bounds.consistent_triplet_distances(*table[pairs].argmax(axis=1)):
+        expected.append([x,y,z])
+    self.assertTrue(expected)
+    self.assertEqual(triplets.tolist(),expected)
+    self.assertTrue((gains >= 0).all())
+
+  def test_pack_triplets(self):
+    triplets = np.array([[0,1,2],[0,3,4],[2,3,4],[1,5,6]])
+    packed,gains = bounds.pack_triplets(triplets,np.array([1.0,3.0,2.0,0.0]))
+    self.assertEqual(packed.tolist(),[[0,3,4]])
+    self.assertEqual(gains.tolist(),[3.0])
+    self.assertEqual(bounds.pack_triplets(triplets,np.zeros(4))[0].shape,(0,3))
+
+
+  def test_shared_distance_bounds(self):
+    table = np.log(np.array([[0.1,0.2,0.3,0.4,1e-9],
+                             [0.4,0.3,0.2,0.1,1e-9],
+                             [0.5,0.5,0.5,0.5,0.5]]))
+    table[:,0] = -np.inf
+    # Pairs 0 and 1 are best 2 apart at offset 0, and the same distance suits
+    # them best together at 2 and 1; pair 2 at offset 3 can only be at 4
+    joint = bounds.shared_distance_bounds(table,np.array([0,1,2]),np.array([1,0,3]),
+                                          np.array([0,2]))
+    self.assertAlmostEqual(joint[0],max(math.log(0.3)+math.log(0.3),
+                                        math.log(0.4)+math.log(0.2)))
+    self.assertAlmostEqual(joint[1],math.log(0.5))
+    self.assertEqual(bounds.shared_distance_bounds(table,np.array([0]),np.array([4]),
+                                                   np.array([0])).tolist(),[-np.inf])
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,37 @@
+# Author: Roman Sloutsky <sloutsky@wustl.edu>
+
+import unittest
+import cPickle as pickle
+from aspen.clade import CladeNode
+
+
+class TestCladeNode(unittest.TestCase):
+
+  def setUp(self):
+    self.cherry = CladeNode(3,1)
+    self.clade = CladeNode(CladeNode(0,self.cherry),CladeNode(4,5))
+
+  def test_nodes_are_interned(self):
+    self.assertIs(CladeNode(1,3),self.cherry)
+    self.assertIs(CladeNode(CladeNode(5,4),CladeNode(self.cherry,0)),self.clade)
+    self.assertIsNot(CladeNode(0,CladeNode(1,4)),CladeNode(4,CladeNode(0,1)))
+    self.assertEqual(hash(CladeNode(1,3)),hash(self.cherry))
+
+  def test_masks_and_depths(self):
+    self.assertEqual(self.cherry.mask,0b1010)
+    self.assertEqual(self.clade.mask,0b111011)
+    self.assertEqual(self.clade.leaves,[0,1,3,4,5])
+    self.assertEqual((self.cherry.depth,self.clade.depth),(1,3))
+    self.assertEqual(dict(self.clade.leaf_depths()),{0:2,1:3,3:3,4:2,5:2})
+
+  def test_nested_set_round_trip(self):
+    nested_set = self.clade.nested_set_repr()
+    self.assertEqual(nested_set,frozenset([frozenset([0,frozenset([1,3])]),
+                                           frozenset([4,5])]))
+    self.assertIs(CladeNode.from_nested_set(nested_set),self.clade)
+    self.assertIs(pickle.loads(pickle.dumps(self.clade,pickle.HIGHEST_PROTOCOL)),
+                  self.clade)
+
+
+if __name__ == '__main__':
+  unittest.main()
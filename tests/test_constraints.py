@@ -0,0 +1,59 @@
+# Author: Roman Sloutsky <sloutsky@wustl.edu>
+
+import unittest
+import cPickle as pickle
+import numpy as np
+from aspen import constraints
+
+
+class TestConstraintCompiler(unittest.TestCase):
+
+  def setUp(self):
+    # Pairs of three leaves, numbered as by topolenum.pair_id
+    self.pair_leaves = ((0,1),(0,2),(1,2))
+    self.histograms = [[(1,0.5),(2,0.3),(3,0.15),(4,0.05)],
+                       [(2,0.9),(3,0.1)],
+                       [(3,0.6),(2,0.4)]]
+    self.log_freq_table = np.log(np.array([[1e-300,0.5,0.3,0.15,0.05],
+                                           [1e-300,1e-300,0.9,0.1,1e-300],
+                                           [1e-300,1e-300,0.4,0.6,1e-300]]))
+    self.compiler = constraints.ConstraintCompiler([0,1,2],self.histograms)
+
+  def test_cutoffs_match_running_sums(self):
+    for cutoff in (0.0,0.3,0.5,0.8,0.95,1.0):
+      expected = sum(1 for h in self.histograms for i in range(len(h))
+                     if sum(f for _,f in h[:i]) < cutoff)
+      self.assertEqual(self.compiler.count_kept([cutoff]),[(cutoff,expected)])
+    self.assertEqual(self.compiler.count_kept([0.9],0.2),[(0.9,5)])
+    self.assertEqual(self.compiler.report(0.9,0.2),(8,6,5))
+
+  def test_from_arrays_matches_histograms(self):
+    offsets = np.cumsum([0]+[len(h) for h in self.histograms])
+    dists = np.array([dist for h in self.histograms for dist,_ in h])
+    freqs = np.array([freq for h in self.histograms for _,freq in h])
+    compiler = constraints.ConstraintCompiler.from_arrays([0,1,2],offsets,dists,freqs)
+    for name in ('pair_ids','dists','freqs','valid','preceding_freqs'):
+      self.assertEqual(getattr(compiler,name).tolist(),getattr(self.compiler,name).tolist())
+
+  def test_compiled_table(self):
+    table = self.compiler.compile(0.9,self.pair_leaves,self.log_freq_table)
+    self.assertEqual([(c.pair,c.dist,c.freq) for c in table],
+                     [(0,1,0.5),(1,2,0.9),(2,2,0.4),(0,2,0.3),(2,3,0.6),
+                      (0,3,0.15)])
+    self.assertEqual(table[2].leaves,frozenset([1,2]))
+    self.assertEqual([c.mask for c in table],[3,5,6,3,6,3])
+    self.assertEqual(table.leaf2.tolist(),[1,2,2,1,2,1])
+    self.assertTrue(np.allclose(table.logfreq,np.log(table.freq)))
+    self.assertFalse(table.dist.flags.writeable)
+    self.assertEqual([ids.tolist() for ids in table.by_pair],[[0,3,5],[1],[2,4]])
+    self.assertEqual({d:ids.tolist() for d,ids in table.by_leaf[0].items()},
+                     {1:[0],2:[1,3],3:[5]})
+    self.assertEqual({d:ids.tolist() for d,ids in table.by_leaf[2].items()},
+                     {2:[1,2],3:[4]})
+    unpickled = pickle.loads(pickle.dumps(table,pickle.HIGHEST_PROTOCOL))
+    self.assertEqual(unpickled,table)
+    self.assertEqual(unpickled.pair.tolist(),table.pair.tolist())
+
+
+if __name__ == '__main__':
+  unittest.main()
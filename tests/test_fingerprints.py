@@ -0,0 +1,101 @@
+# Author: Roman Sloutsky <sloutsky@wustl.edu>
+
+import sys
+import unittest
+import multiprocessing
+from aspen import fingerprints as fp
+from aspen.topolenum import SharedCladeReprTracker
+
+
+def add_in_child(fingerprint_set,keys):
+  for key in keys:
+    fingerprint_set[key] = None
+
+
+def check_in_child(fingerprint_set,keys):
+  if not all(key in fingerprint_set for key in keys):
+    sys.exit(1)
+
+
+class TestSharedFingerprintSet(unittest.TestCase):
+
+  def test_dict_operations(self):
+    s = fp.SharedFingerprintSet(1000,num_stripes=4)
+    self.assertEqual((s.num_stripes,s.capacity),(4,1024))
+    s['[(1,2)]'] = None
+    s['[(1,2)]'] = None
+    self.assertIn('[(1,2)]',s)
+    self.assertNotIn('[(1,3)]',s)
+    self.assertEqual(len(s),1)
+    s.pop('[(1,2)]')
+    self.assertNotIn('[(1,2)]',s)
+    self.assertRaises(KeyError,s.pop,'[(1,2)]')
+    self.assertEqual(len(s),0)
+
+  def test_probing_through_tombstones(self):
+    # All fingerprints in one stripe, starting at the same slot
+    s = fp.SharedFingerprintSet(8,num_stripes=1)
+    for i in xrange(2,8):
+      self.assertTrue(s.add_fingerprint(i << 3))
+    self.assertTrue(s.discard_fingerprint(3 << 3))
+    self.assertTrue(s.contains_fingerprint(7 << 3))
+    self.assertEqual(s.stats().tombstones,1)
+    # The last slot of a run of probes is emptied rather than marked deleted
+    self.assertTrue(s.discard_fingerprint(7 << 3))
+    self.assertEqual(s.stats().tombstones,1)
+    self.assertTrue(s.add_fingerprint(9 << 3))
+    self.assertEqual(s.stats().tombstones,0)
+    self.assertEqual(sorted(s.fingerprints()),[i << 3 for i in (2,4,5,6,9)])
+    stats = s.stats()
+    self.assertEqual((stats.size,stats.load_factor),(5,5/8.0))
+    self.assertTrue(stats.collisions > 0)
+
+  def test_full_stripe_grows(self):
+    s = fp.SharedFingerprintSet(8,num_stripes=1,max_load_factor=0.5)
+    for i in xrange(2,6):
+      s.add_fingerprint(i)
+    self.assertEqual(s.capacity,8)
+    self.assertTrue(s.add_fingerprint(6))
+    self.assertEqual(s.capacity,16)
+    self.assertEqual(sorted(s.fingerprints()),range(2,7))
+    # Tombstones are cleared once they fill the stripe, without growing it
+    for i in xrange(7,40):
+      s.discard_fingerprint(i-5)
+      s.add_fingerprint(i)
+    self.assertEqual(sorted(s.fingerprints()),range(35,40))
+    self.assertEqual(s.capacity,16)
+    s.close()
+
+  def test_growth_seen_by_other_processes(self):
+    s = fp.SharedFingerprintSet(8,num_stripes=2)
+    keys = [str(i) for i in xrange(100)]
+    p = multiprocessing.Process(target=add_in_child,args=(s,keys[:50]))
+    p.start()
+    p.join()
+    self.assertTrue(s.capacity > 16)
+    self.assertTrue(all(key in s for key in keys[:50]))
+    add_in_child(s,keys[50:])
+    p = multiprocessing.Process(target=check_in_child,args=(s,keys))
+    p.start()
+    p.join()
+    self.assertEqual(p.exitcode,0)
+    self.assertEqual(len(s),100)
+    s.close()
+
+  def test_shared_between_processes(self):
+    s = fp.SharedFingerprintSet(1000)
+    tracker = SharedCladeReprTracker(set('abcd'),s)
+    cladesets = [[frozenset({frozenset({0,1}),'r'})],
+                 [frozenset({frozenset({frozenset({0,1}),2}),'r'})]]
+    p = multiprocessing.Process(target=add_in_child,
+                                args=(s,[tracker.make_str_repr(c) for c in cladesets]))
+    p.start()
+    p.join()
+    self.assertTrue(all(tracker.already_encountered(c) for c in cladesets))
+    tracker.forget(cladesets[0])
+    self.assertFalse(tracker.already_encountered(cladesets[0]))
+    self.assertEqual(len(s),1)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,61 @@
+# Author: Roman Sloutsky <sloutsky@wustl.edu>
+
+import unittest
+import os
+import math
+from aspen import preflight
+from aspen.pwhist import load_pwhist
+
+
+EXAMPLES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            '..','examples')
+
+
+class TestPreflight(unittest.TestCase):
+
+  def setUp(self):
+    self.histograms = [(frozenset(['a','b']),[(1,0.8),(2,0.2)]),
+                       (frozenset(['a','c']),[(2,0.7),(3,0.3)]),
+                       (frozenset(['b','c']),[(2,0.6),(1,0.4)])]
+
+  def test_feasible_example(self):
+    histograms = load_pwhist(os.path.join(EXAMPLES_DIR,
+                                          'pw_path_length_histograms1.txt'))
+    report = preflight.check(histograms,0.99,0.001)
+    self.assertEqual(report.num_leaves,15)
+    self.assertEqual(report.constraint_counts,(546,399,399))
+    self.assertFalse(report.infeasible_pairs or report.missing_pairs)
+    self.assertEqual(len(report.leaves_without_cherry_partner),5)
+    self.assertAlmostEqual(report.best_possible,-48.330613,places=5)
+    self.assertAlmostEqual(report.log10_topologies,14.3,places=1)
+    self.assertLessEqual(report.log10_search_space,report.log10_topologies)
+    self.assertIn('Leaves: 15',preflight.format_report(report))
+
+  def test_search_space_bound(self):
+    report = preflight.analyze(self.histograms,0.5,0.5)
+    # Only distance 1 is feasible for (a,b), 2 for (a,c) and (b,c), which is
+    # what the one topology ((a,b),c) has
+    self.assertEqual(report.log10_search_space,0.0)
+    self.assertAlmostEqual(report.log10_topologies,math.log10(3))
+    self.assertEqual(report.leaves_without_cherry_partner,['c'])
+    self.assertAlmostEqual(report.best_possible,sum(map(math.log,(0.8,0.7,0.6))))
+
+  def test_infeasible_configurations(self):
+    # Distances above 2 are impossible between 3 leaves
+    histograms = self.histograms[:1]+[(frozenset(['a','c']),[(3,1.0)])]+\
+                 self.histograms[2:]
+    report = preflight.analyze(histograms,0.9,0.01)
+    self.assertEqual(report.infeasible_pairs,[('a','c')])
+    with self.assertRaises(preflight.InfeasibleConfigurationError):
+      preflight.check(histograms,0.9,0.01)
+    # No distance 1 constraint anywhere
+    histograms = [(frozenset(['a','b']),[(2,0.8),(1,0.2)])]+self.histograms[1:]
+    with self.assertRaises(ValueError) as cm:
+      preflight.check(histograms,0.5,0.01)
+    self.assertIn('no cherry',str(cm.exception))
+    report = preflight.analyze(self.histograms[1:],0.9,0.01)
+    self.assertEqual(report.missing_pairs,[('a','b')])
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,124 @@
+# Author: Roman Sloutsky <sloutsky@wustl.edu>
+
+import unittest
+import os
+import glob
+import shutil
+import tempfile
+import cPickle as pickle
+from cStringIO import StringIO
+from aspen import pwhist
+
+
+EXAMPLES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            '..','examples')
+
+
+class TestPWHistParser(unittest.TestCase):
+
+  def test_parsing_matches_eval_on_examples(self):
+    for fpath in glob.glob(os.path.join(EXAMPLES_DIR,'*.txt')):
+      with open(fpath) as fh:
+        expected = [(eval(l.split('\t')[0]),eval(l.split('\t')[1])) for l in fh]
+      with open(fpath) as fh:
+        self.assertEqual(list(pwhist.iter_pwhist(fh)),expected)
+
+  def test_small_blocks_and_blank_lines(self):
+    lines = ["frozenset(['a', 'b'])\t[(1, 0.75), (2, 0.25)]\n",
+             "\n",
+             "frozenset({'a', 'c'})\t[(2, 1.0)]\n",
+             "frozenset([\"b\", \"c\"])\t[(3, 0.5), (2, 0.3), (4, 0.2)]"]
+    parsed = list(pwhist.iter_pwhist(StringIO(''.join(lines)),block_size=2))
+    self.assertEqual(parsed,[(frozenset(['a','b']),[(1,0.75),(2,0.25)]),
+                             (frozenset(['a','c']),[(2,1.0)]),
+                             (frozenset(['b','c']),[(3,0.5),(2,0.3),(4,0.2)])])
+
+  def test_leaf_names_with_separators(self):
+    lines = ["frozenset(['a, b', 'c'])\t[(1, 1.0)]\n",
+             "frozenset([\"it's, 1\", 'c, d'])\t[(2, 1.0)]\n"]
+    self.assertEqual(list(pwhist.iter_pwhist(StringIO(''.join(lines)))),
+                     [(eval(l.split('\t')[0]),eval(l.split('\t')[1])) for l in lines])
+
+  def test_unicode_leaf_names_and_empty_histograms(self):
+    lines = ["frozenset([u'a', u'b, c'])\t[(1, 1.0)]\n",
+             "frozenset({u'a', 'd'})\t[]\n",
+             "frozenset(['b, c', 'd'])\t[(2, 0.5), (3, 0.5)]\n"]
+    parsed = list(pwhist.iter_pwhist(StringIO(''.join(lines)),block_size=2))
+    self.assertEqual(parsed,[(eval(l.split('\t')[0]),eval(l.split('\t')[1]))
+                             for l in lines])
+    self.assertEqual(pwhist.parse_pwhist_line(lines[1]),
+                     (frozenset(['a','d']),[]))
+    self.assertEqual(list(pwhist.iter_pwhist(StringIO(lines[1]))),
+                     [(frozenset(['a','d']),[])])
+
+  def test_malformed_lines_are_reported_with_line_number(self):
+    good = "frozenset(['a', 'b'])\t[(1, 0.75), (2, 0.25)]\n"
+    for bad in ["frozenset(['a', 'c'])[(1, 1.0)]\n",
+                "__import__('os').getcwd()\t[(1, 1.0)]\n",
+                "frozenset(['a', 'a'])\t[(1, 1.0)]\n",
+                "frozenset(['a', 'b', 'c'])\t[(1, 1.0)]\n",
+                "frozenset(['a', 'b', ])\t[(1, 1.0)]\n",
+                "frozenset(['a'])\t[(1, 1.0)]\n",
+                "frozenset([a, c])\t[(1, 1.0)]\n",
+                "frozenset([u'a', b'c'])\t[(1, 1.0)]\n",
+                "frozenset(['a', 'c'])\t[ ]\n",
+                "frozenset(['a', 'c'])\t(1, 1.0)\n",
+                "frozenset(['a', 'c'])\t[(1, 1.0, 2), (3, 0.5, 4)]\n",
+                "frozenset(['a', 'c'])\t[(1.5, 1.0)]\n",
+                "frozenset(['a', 'c'])\t[(1, x)]\n"]:
+      with self.assertRaises(pwhist.PWHistFormatError) as cm:
+        list(pwhist.iter_pwhist(StringIO(good*3+bad+good),source='test'))
+      self.assertTrue(str(cm.exception).startswith('test, line 4:'))
+      self.assertIsInstance(cm.exception,ValueError)
+
+
+class TestCompiledPWHist(unittest.TestCase):
+
+  def setUp(self):
+    self.tmpdir = tempfile.mkdtemp()
+    self.source = os.path.join(EXAMPLES_DIR,'pw_path_length_histograms1.txt')
+    self.target = os.path.join(self.tmpdir,'histograms.compiled')
+    with open(self.source) as fh:
+      self.expected = list(pwhist.iter_pwhist(fh))
+
+  def tearDown(self):
+    shutil.rmtree(self.tmpdir)
+
+  def test_compiled_file_round_trip(self):
+    pwhist.compile_pwhist(self.source,self.target)
+    self.assertTrue(pwhist.is_compiled_pwhist(self.target))
+    self.assertFalse(pwhist.is_compiled_pwhist(self.source))
+    compiled = pwhist.load_pwhist(self.target)
+    self.assertIsInstance(compiled,pwhist.CompiledPWHist)
+    self.assertEqual(len(compiled),len(self.expected))
+    self.assertEqual(list(compiled),self.expected)
+    self.assertEqual(compiled[-1],self.expected[-1])
+    self.assertSequenceEqual(compiled.leaf_names,
+                             sorted({l for p,_ in self.expected for l in p}))
+    self.assertFalse(compiled.freqs.flags.writeable)
+
+  def test_compiling_from_parsed_histograms(self):
+    pwhist.compile_pwhist(self.expected[:10],self.target)
+    self.assertEqual(list(pwhist.load_pwhist(self.target)),self.expected[:10])
+
+  def test_pickles_by_path(self):
+    pwhist.compile_pwhist(self.source,self.target)
+    compiled = pwhist.CompiledPWHist(self.target)
+    pickled = pickle.dumps(compiled,pickle.HIGHEST_PROTOCOL)
+    self.assertLess(len(pickled),len(self.target)+100)
+    self.assertEqual(list(pickle.loads(pickled)),self.expected)
+
+  def test_rejects_bad_files(self):
+    with self.assertRaises(pwhist.PWHistFormatError):
+      pwhist.CompiledPWHist(self.source)
+    pwhist.compile_pwhist(self.source,self.target)
+    with open(self.target,'rb') as fh:
+      truncated = fh.read()[:1000]
+    with open(self.target,'wb') as wh:
+      wh.write(truncated)
+    with self.assertRaises(pwhist.PWHistFormatError):
+      pwhist.CompiledPWHist(self.target)
+
+
+if __name__ == '__main__':
+  unittest.main()
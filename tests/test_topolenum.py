@@ -4,11 +4,24 @@ import unittest
 import os
 import threading
 import time
+import shutil
+import tempfile
+import math
+import heapq
+import numpy as np
+import itertools
 import cPickle as pickle
 from cStringIO import StringIO
 from multiprocessing import Condition,Pipe
 from mock import patch,call,mock_open,Mock,PropertyMock
+from Bio import Phylo
 from aspen import topolenum as te
+from aspen.pwhist import load_pwhist,compile_pwhist
+from aspen.fingerprints import SharedFingerprintSet,fingerprint
+
+
+EXAMPLES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            '..','examples')
 
 
 @patch('tempfile.NamedTemporaryFile')
@@ -980,6 +993,403 @@ class TestSharedFIFOfileIntegration(unittest.TestCase):
       self.fifo_obj.tmpdir_obj.__exit__(None,None,None)
 
 
+
+def synthesize_histograms(tree):
+  # Histograms peaked at the leaf pair distances of the given tree, which is
+  # given as nested tuples of leaf names
+  def leaf_paths(clade,path=()):
+    if isinstance(clade,str):
+      return {clade:path}
+    paths = {}
+    for i,c in enumerate(clade):
+      paths.update(leaf_paths(c,path+(i,)))
+    return paths
+  paths = leaf_paths(tree)
+  histograms = []
+  for leaf1,leaf2 in itertools.combinations(sorted(paths),2):
+    shared = 0
+    while paths[leaf1][shared] == paths[leaf2][shared]:
+      shared += 1
+    dist = len(paths[leaf1])+len(paths[leaf2])-2*shared-1
+    histograms.append((frozenset([leaf1,leaf2]),
+                       [(dist,0.7),(dist+1,0.2),(dist-1 if dist > 1 else dist+2,0.1)]))
+  return histograms
+
+
+class TestTreeAssembly(unittest.TestCase):
+  
+  tree = ((('a','b'),('c',('d','e'))),('f','g'))
+  
+  # All complete assemblies of the tree above, as produced by exhaustive search
+  expected_assemblies = [
+    (-7.49017382,'[(((1,2),((4,5),3)),(6,7))]'),
+    (-18.47248754,'[((((1,2),((4,5),3)),7),6)]'),
+    (-18.47248754,'[((((1,2),((4,5),3)),6),7)]'),
+    (-22.79039223,'[(((1,2),(6,7)),((4,5),3))]'),
+    (-23.48353941,'[(((1,2),((3,5),4)),(6,7))]'),
+    (-23.48353941,'[(((1,2),((3,4),5)),(6,7))]'),
+    (-25.98906535,'[(((((4,5),3),2),1),(6,7))]'),
+    (-25.98906535,'[(((((4,5),3),1),2),(6,7))]'),
+    (-26.68221253,'[((1,2),(((4,5),3),(6,7)))]'),
+    (-26.68221253,'[((((1,2),3),(4,5)),(6,7))]'),
+    (-26.68221253,'[((((1,2),(6,7)),3),(4,5))]'),
+    (-26.68221253,'[((((1,2),(4,5)),3),(6,7))]'),
+    (-26.81574392,'[(((((4,5),3),2),(6,7)),1)]'),
+    (-26.81574392,'[(((((4,5),3),1),(6,7)),2)]'),
+    (-28.06850689,'[((((1,2),(6,7)),(4,5)),3)]'),
+    (-28.06850689,'[(((((4,5),3),(6,7)),2),1)]'),
+    (-28.06850689,'[(((((4,5),3),(6,7)),1),2)]'),
+    (-28.06850689,'[(((((1,2),(6,7)),3),5),4)]'),
+    (-28.06850689,'[(((((1,2),(6,7)),3),4),5)]'),
+    (-30.70756422,'[((((1,2),(6,7)),(3,5)),4)]'),
+    (-30.70756422,'[((((1,2),(6,7)),(3,4)),5)]')]
+  
+  def setUp(self):
+    self.histograms = synthesize_histograms(self.tree)
+    self.leaves = {leaf for pair,_ in self.histograms for leaf in pair}
+    self.zeroth_assembly = te.TreeAssembly(self.histograms,0.9,self.leaves,0.01)
+  
+  def enumerate_complete_assemblies(self):
+    encountered = te.SharedCladeReprTracker(self.leaves,{})
+    stack = [self.zeroth_assembly]
+    complete = []
+    while stack:
+      for extended in stack.pop().generate_extensions(encountered) or []:
+        if extended.complete:
+          complete.append(extended)
+        else:
+          stack.append(extended)
+    return complete,encountered
+  
+  def test_pair_ids_are_dense_and_symmetric(self):
+    ids = [te.pair_id(leaf1,leaf2) for leaf1,leaf2 in
+                                    itertools.combinations(range(7),2)]
+    self.assertEqual(sorted(ids),range(21))
+    self.assertEqual(te.pair_id(2,5),te.pair_id(5,2))
+    self.assertEqual(self.zeroth_assembly.pair_leaves[te.pair_id(5,2)],(2,5))
+  
+  def test_leaves_are_interned(self):
+    self.assertEqual(self.zeroth_assembly.leaf_names,tuple('abcdefg'))
+    self.assertEqual(self.zeroth_assembly.free_leaves,set(range(7)))
+    self.assertTrue(all(isinstance(c.pair,int) and isinstance(c.dist,int)
+                        for c in self.zeroth_assembly.constraints_master))
+  
+  def test_log_frequency_table(self):
+    table = self.zeroth_assembly.log_freq_table
+    self.assertEqual(table.shape,(21,7))
+    self.assertFalse(table.flags.writeable)
+    ab,ag = te.pair_id(0,1),te.pair_id(0,6)
+    self.assertAlmostEqual(table[ab,1],math.log(0.7))
+    self.assertAlmostEqual(table[ab,3],math.log(0.1))
+    self.assertEqual(table[ab,4],-float('inf'))
+    self.assertAlmostEqual(self.zeroth_assembly.log_freqs[ag][5],math.log(0.2))
+    self.assertAlmostEqual(self.zeroth_assembly.best_possible,21*math.log(0.7))
+  
+  def test_compiled_histograms_give_the_same_tables(self):
+    tmpdir = tempfile.mkdtemp()
+    try:
+      histograms = self.histograms[::-1]
+      compiled_file = compile_pwhist(histograms,os.path.join(tmpdir,'histograms.compiled'))
+      assembly = te.TreeAssembly(histograms,0.9,self.leaves,0.01)
+      expected = (assembly.log_freq_table,assembly.constraints_master)
+      assembly = te.TreeAssembly(load_pwhist(compiled_file),0.9,self.leaves,0.01)
+      self.assertEqual(assembly.log_freq_table.tolist(),expected[0].tolist())
+      self.assertEqual(assembly.constraints_master,expected[1])
+    finally:
+      shutil.rmtree(tmpdir)
+  
+  def test_exhaustive_enumeration(self):
+    complete,encountered = self.enumerate_complete_assemblies()
+    found = sorted(((round(a.score,8),
+                     encountered.make_str_repr(a.current_clades_as_nested_sets))
+                    for a in complete),reverse=True)
+    self.assertEqual(found,self.expected_assemblies)
+    best = max(complete,key=lambda a: a.score)
+    best_tree = Phylo.read(StringIO(best.as_newick()),'newick')
+    self.assertEqual({''.join(sorted(l.name for l in c.get_terminals()))
+                      for c in best_tree.find_clades()},
+                     {'a','b','c','d','e','f','g','ab','de','cde','abcde','fg',
+                      'abcdefg'})
+  
+  def test_setup_computes_no_nan(self):
+    # Pairs with nothing observed at or beyond distance 1 have no cherry bonus
+    histograms = [(pair,hist if pair != frozenset('ab') else [(1,0.0)])
+                  for pair,hist in self.histograms]
+    with np.errstate(invalid='raise'):
+      assembly = te.TreeAssembly(histograms,0.9,self.leaves,0.01)
+    self.assertFalse(np.isnan(assembly.cherry_bonuses).any())
+  
+  def test_canonical_extensions_reach_each_assembly_once(self):
+    # The last extension of an assembly is made in place
+    stack = [self.zeroth_assembly.copy()]
+    _,encountered = self.enumerate_complete_assemblies()
+    tracker = te.SharedCladeReprTracker(self.leaves,{})
+    reached = []
+    while stack:
+      for extended in stack.pop().generate_extensions(tracker,canonical=True) or []:
+        reached.append(tracker.make_str_repr(extended.current_clades_as_nested_sets))
+        if extended.complete:
+          self.assertIn(reached[-1],tracker.encountered)
+        else:
+          stack.append(extended)
+    self.assertEqual(len(reached),len(set(reached)))
+    self.assertEqual(set(reached),set(encountered.encountered))
+    self.assertEqual(len(tracker.encountered),len(self.expected_assemblies))
+  
+  def test_compress_uncompress_round_trip(self):
+    encountered = te.SharedCladeReprTracker(self.leaves,{})
+    partial = self.zeroth_assembly.generate_extensions(encountered)
+    partial = partial[0].generate_extensions(encountered)
+    for assembly in partial:
+      restored = te.TreeAssembly.uncompress(assembly.compress())
+      self.assertEqual(restored.score,assembly.score)
+      self.assertEqual(restored.free_leaves,assembly.free_leaves)
+      self.assertEqual(restored.live_constraints.tolist(),
+                       assembly.live_constraints.tolist())
+      self.assertEqual(set(restored.current_clades_as_nested_sets),
+                       set(assembly.current_clades_as_nested_sets))
+      self.assertEqual(sorted(restored.clade_masks),sorted(assembly.clade_masks))
+      self.assertEqual(restored.distances_to_root.tolist(),
+                       assembly.distances_to_root.tolist())
+      # Sort keys are carried in the state, or recomputed for saved states without them
+      self.assertEqual(restored._sort_key,assembly.sort_key)
+      self.assertEqual(te.TreeAssembly.uncompress(assembly.compress()[:4]).sort_key,
+                       assembly.sort_key)
+
+  
+  def test_best_case_within_per_pair_maximum(self):
+    encountered = te.SharedCladeReprTracker(self.leaves,{})
+    assemblies = self.zeroth_assembly.generate_extensions(encountered)
+    assemblies += assemblies[0].generate_extensions(encountered)
+    for assembly in assemblies:
+      self.assertEqual(assembly.best_case_terms.tolist(),
+                       assembly.all_best_case_terms().tolist())
+      depths = assembly.distances_to_root
+      expected = assembly.score
+      for pair,(leaf1,leaf2) in enumerate(assembly.pair_leaves):
+        if not assembly.pairs_accounted_for[pair]:
+          expected += max(assembly.log_freqs[pair][depths[leaf1]+depths[leaf2]+1:]+
+                          [-float('inf')])
+      # Cherries sharing a leaf can't all take their distance 1 frequencies
+      if expected == -float('inf') or assembly.calculate_best_case() == -float('inf'):
+        continue
+      self.assertTrue(assembly.calculate_best_case() <= expected+1e-9)
+  
+  def test_best_case_bounds_completed_assemblies(self):
+    encountered = te.SharedCladeReprTracker(self.leaves,{})
+    stack = [(self.zeroth_assembly,self.zeroth_assembly.best_case)]
+    while stack:
+      assembly,bound = stack.pop()
+      for extended in assembly.generate_extensions(encountered) or []:
+        self.assertTrue(extended.best_case > -float('inf'))
+        self.assertTrue(extended.best_case <= bound+1e-9)
+        if extended.complete:
+          self.assertAlmostEqual(extended.best_case,extended.score)
+        else:
+          stack.append((extended,extended.best_case))
+  
+  def test_cherries_sharing_a_leaf_are_bounded_together(self):
+    def histograms(cherry):
+      return [(pair,cherry if 'a' in pair and pair & {'b','c'} else [(2,0.6),(3,0.4)])
+              for pair in map(frozenset,itertools.combinations('abcd',2))]
+    # a can be in a cherry with b or with c, but not with both
+    assembly = te.TreeAssembly(histograms([(1,0.8),(2,0.2)]),0.9,set('abcd'),0.01)
+    bonus = math.log(0.8)-math.log(0.2)
+    self.assertAlmostEqual(assembly.cherry_bonuses[0,1],bonus)
+    self.assertAlmostEqual(assembly.best_case,4*math.log(0.6)+2*math.log(0.2)+1.5*bonus)
+    # and if a is in a cherry with nothing else, then with neither
+    assembly = te.TreeAssembly(histograms([(1,1.0)]),0.9,set('abcd'),0.01)
+    self.assertTrue(assembly.forced_cherries[0,1] and assembly.forced_cherries[0,2])
+    self.assertEqual(assembly.best_case,-float('inf'))
+    self.assertIsNone(assembly.generate_extensions(te.SharedCladeReprTracker(set('abcd'),
+                                                                             {}),
+                                                   -float('inf')))
+  
+  def test_uncompletable_extensions(self):
+    # Once a and b are in a cherry, a and c can't be at distance 1, the only one
+    # they were observed at
+    histograms = [(pair,[(1,1.0)] if pair == frozenset('ac') else [(1,0.5),(2,0.3),(3,0.2)])
+                  for pair in map(frozenset,itertools.combinations('abcd',2))]
+    assembly = te.TreeAssembly(histograms,0.4,set('abcd'),0.01)
+    self.assertTrue(assembly.best_case > -float('inf'))
+    cherry = [c for c in assembly.constraints_master
+              if c.dist == 1 and c.leaves == frozenset({0,1})][0]
+    self.assertEqual(assembly.best_case_with_extension(cherry),-float('inf'))
+    # and is never generated
+    self.assertNotIn([3],[e.clade_masks for e in assembly.generate_extensions(
+                                            te.SharedCladeReprTracker(set('abcd'),{}))])
+  
+  def test_triplet_bound(self):
+    histograms = load_pwhist(os.path.join(EXAMPLES_DIR,'pw_path_length_histograms2.txt'))
+    leaves = {leaf for pair,_ in histograms for leaf in pair}
+    pair_bound = te.TreeAssembly(histograms,0.99,leaves,0.001).best_case
+    zeroth = te.TreeAssembly(histograms,0.99,leaves,0.001,triplet_bound=True)
+    self.assertEqual(len(zeroth.triplet_leaves),3)
+    self.assertAlmostEqual(zeroth.best_case,pair_bound-zeroth.triplet_gains.sum())
+    encountered = te.SharedCladeReprTracker(leaves,{})
+    assemblies = zeroth.generate_extensions(encountered)
+    assemblies += assemblies[0].generate_extensions(encountered)
+    for assembly in assemblies:
+      self.assertEqual(assembly.best_case_terms.tolist(),
+                       assembly.all_best_case_terms().tolist())
+      free = [all(leaf in assembly.free_leaves for leaf in triplet)
+              for triplet in zeroth.triplet_leaves.tolist()]
+      self.assertEqual(assembly.best_case_terms[-3:].tolist(),
+                       [-gain if f else 0.0 for gain,f in zip(zeroth.triplet_gains,free)])
+  
+  def test_triplet_bound_prunes_assemblies(self):
+    def best_first(zeroth,num_topologies):
+      # Scores of the best topologies, found by extending assemblies best case
+      # first, and the number of assemblies extended
+      encountered = te.SharedCladeReprTracker(self.leaves,{})
+      counter = itertools.count()
+      heap = [(-zeroth.best_case,next(counter),zeroth)]
+      scores = []
+      extended = 0
+      while heap:
+        best_case,_,assembly = heapq.heappop(heap)
+        min_score = scores[0] if len(scores) == num_topologies else None
+        if min_score is not None and -best_case < min_score:
+          break
+        extended += 1
+        for a in assembly.generate_extensions(encountered,min_score) or []:
+          self.assertEqual(a.best_case_terms.tolist(),a.all_best_case_terms().tolist())
+          if not a.complete:
+            heapq.heappush(heap,(-a.best_case,next(counter),a))
+          elif len(scores) < num_topologies:
+            heapq.heappush(scores,a.score)
+          else:
+            heapq.heappushpop(scores,a.score)
+      return [round(score,8) for score in sorted(scores,reverse=True)],extended
+    pair_bound = self.zeroth_assembly.best_case
+    scores,extended = best_first(self.zeroth_assembly.copy(),3)
+    zeroth = te.TreeAssembly(self.histograms,0.9,self.leaves,0.01,triplet_bound=True)
+    # No triplet of this tree's leaves is packed, so only pairs between built clades
+    # are bounded jointly
+    self.assertEqual(len(zeroth.triplet_leaves),0)
+    self.assertEqual(zeroth.best_case,pair_bound)
+    t_scores,t_extended = best_first(zeroth,3)
+    self.assertEqual(t_scores,scores)
+    self.assertEqual(scores,[score for score,_ in self.expected_assemblies[:3]])
+    self.assertTrue(t_extended < extended)
+  
+  def test_beam_search_finds_good_topologies(self):
+    found = te.beam_search(self.zeroth_assembly,10,5)
+    self.assertEqual(len(found),5)
+    self.assertTrue(all(a.complete for a in found))
+    encountered = te.SharedCladeReprTracker(self.leaves,{})
+    found = [(round(a.score,8),encountered.make_str_repr(a.current_clades_as_nested_sets))
+             for a in found]
+    self.assertEqual(found,sorted(set(found),reverse=True))
+    self.assertTrue(set(found) <= set(self.expected_assemblies))
+    self.assertEqual(found[0],self.expected_assemblies[0])
+    # The zeroth assembly is left as it was
+    self.assertEqual(self.zeroth_assembly.free_leaves,set(range(7)))
+    # Seeded with the topologies found, and the lowest of their scores, enumeration
+    # finds the rest of the best 5
+    stack = [self.zeroth_assembly]
+    for _,string_repr in found:
+      encountered.encountered[string_repr] = None
+    complete = []
+    while stack:
+      for extended in stack.pop().generate_extensions(encountered,found[-1][0]) or []:
+        if extended.complete:
+          complete.append((round(extended.score,8),encountered.make_str_repr(
+                                               extended.current_clades_as_nested_sets)))
+        elif extended.best_case >= found[-1][0]:
+          stack.append(extended)
+    self.assertEqual([score for score,_ in sorted(found+complete,reverse=True)[:5]],
+                     [score for score,_ in self.expected_assemblies[:5]])
+  
+  def test_extended_assemblies_share_parent_arrays(self):
+    encountered = te.SharedCladeReprTracker(self.leaves,{})
+    parent = self.zeroth_assembly.generate_extensions(encountered)[0]
+    parent_live = parent.live_constraints
+    parent_terms = parent.best_case_terms
+    saved_live,saved_terms = parent_live.tolist(),parent_terms.tolist()
+    children = parent.generate_extensions(encountered)
+    self.assertTrue(len(children) > 1)
+    for child in children:
+      self.assertIs(child._live_constraints,parent_live)
+      self.assertIs(child._best_case_terms_delta[0],parent_terms)
+    for child in children:
+      restored = te.TreeAssembly.uncompress(child.compress())
+      self.assertEqual(child.live_constraints.tolist(),restored.live_constraints.tolist())
+      self.assertEqual(child.best_case_terms.tolist(),restored.best_case_terms.tolist())
+    self.assertEqual(parent_live.tolist(),saved_live)
+    self.assertEqual(parent_terms.tolist(),saved_terms)
+  
+  def test_only_extensions_within_min_score_are_looked_up(self):
+    encountered = Mock(wraps=te.SharedCladeReprTracker(self.leaves,{}))
+    self.assertIsNone(self.zeroth_assembly.generate_extensions(
+                                   encountered,self.zeroth_assembly.best_case+1.0))
+    self.assertFalse(encountered.already_encountered.called)
+    extended = self.zeroth_assembly.generate_extensions(encountered,-float('inf'))
+    self.assertEqual(encountered.already_encountered.call_count,len(extended))
+  
+  def test_encountered_set_grows_during_enumeration(self):
+    class ListFIFO(list):
+      def push(self,item):
+        self.append(item)
+      def pop(self):
+        return list.pop(self,0) if self else None
+    class Workspace(te.AssemblyWorkspace):
+      def log(self,*args,**kwargs):
+        pass
+    def enumerate_with(storage):
+      workspace = Workspace(self.zeroth_assembly.copy(),25,10,
+                            te.SharedCladeReprTracker(self.leaves,storage),
+                            fifo=ListFIFO(),canonical_extensions=False)
+      while workspace.workspace or workspace.fifo:
+        workspace.iterate()
+      return [(a.score,a.as_newick()) for a in workspace.accepted_assemblies]
+    remembered = {}
+    encountered = SharedFingerprintSet(8,num_stripes=1)
+    self.assertEqual(enumerate_with(encountered),enumerate_with(remembered))
+    # Far more assemblies were remembered than fit in the set it started as
+    self.assertTrue(len(remembered) > 8)
+    self.assertTrue(encountered.capacity > 8)
+    self.assertEqual(sorted(encountered.fingerprints()),
+                     sorted(fingerprint(key) for key in remembered))
+    encountered.close()
+  
+  def test_pending_assemblies_match_built_assemblies(self):
+    def state(compressed):
+      return (set(te.TreeAssembly.decode_clades(compressed[0])),)+tuple(compressed[1:])
+    assembly = self.zeroth_assembly.generate_extensions(
+                                        te.SharedCladeReprTracker(self.leaves,{}))[0]
+    built = assembly.copy().generate_extensions(te.SharedCladeReprTracker(self.leaves,{}))
+    pending = assembly.copy().generate_extensions(te.SharedCladeReprTracker(self.leaves,{}),
+                                                  lazy=True)
+    self.assertIsInstance(pending[-1],te.TreeAssembly)
+    self.assertTrue(all(isinstance(a,te.PendingAssembly) for a in pending[:-1]))
+    self.assertEqual([state(a.compress()) for a in pending],
+                     [state(a.compress()) for a in built])
+    self.assertEqual([a.sort_key for a in pending],[a.sort_key for a in built])
+    for a,b in zip(pending[:-1],built):
+      materialized = a.materialize()
+      self.assertEqual(state(materialized.compress()),state(b.compress()))
+      self.assertEqual([set(kind) for kind in materialized.candidates],
+                       [set(kind) for kind in b.candidates])
+  
+  def test_carried_candidates_match_full_tally(self):
+    def summarize(candidates):
+      return [{key:(sorted(ext.consistent),sorted(ext.inconsistent),
+                    sorted(ext.unverified.items()),round(ext.score,8))
+               for key,ext in kind.items()} for kind in candidates]
+    encountered = te.SharedCladeReprTracker(self.leaves,{})
+    stack = [self.zeroth_assembly]
+    checked = 0
+    while stack:
+      assembly = stack.pop()
+      carried = hasattr(assembly,'_parent_candidates')
+      if carried:
+        self.assertEqual(summarize(assembly.candidates),
+                         summarize(assembly.tally_candidates()))
+        checked += 1
+      stack.extend(assembly.generate_extensions(encountered) or [])
+    self.assertTrue(checked > 0)
+
 if __name__ == "__main__":
   #import sys;sys.argv = ['', 'Test.testName']
   unittest.main()